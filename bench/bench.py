@@ -0,0 +1,222 @@
+"""Benchmark every render stage of OEPL-Dash against the recorded fixtures.
+
+    python bench/bench.py                   compare against bench/baseline.json
+    python bench/bench.py --update          record a new baseline
+    python bench/bench.py --stage draw      only run stages containing "draw"
+
+The AP, Open-Meteo and CalDAV are replaced by the local stand-in in bench/standin.py.
+Each stage reports the median wall time of its runs and the peak RSS of a fresh bench process that
+ran it once, which unlike the Python heap includes Pillow's image buffers.
+The exit status is 1 if a stage got slower or bigger than the baseline by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+CALENDAR_SETS = ["empty", "typical", "overlapping"]
+
+def configure(server, cachedir):
+    os.environ.update({
+        "ACCESSPOINTIP": server.url,
+        "MAC": "0000021C6F3EB19B",
+        "CALDAV_URL": "http://" + server.url + "/dav/",
+        "CAL_USERNAME": "bench",
+        "CAL_PASSWORD": "bench",
+        "CALENDAR_NAME": "Calendar 1",
+        "CALENDAR_COLOR": "5",
+        "TIMEZONE": "Europe/Berlin",
+        "CALENDAR_FONT": "fonts/Roboto-SemiBold.ttf",
+        "LATITUDE": "50",
+        "LONGITUDE": "10",
+        "WEATHER_URL": "http://" + server.url + "/v1/forecast",
+        "WEATHER_TTL": "0",
+        "WEATHER_FONT": "fonts/Roboto-SemiBold.ttf",
+        "HEADER_FONT": "fonts/Roboto-SemiBold.ttf",
+        "CACHE_DIR": cachedir,
+        "SKIPUPLOAD": "False",
+        "FORCE_REFRESH": "True",
+    })
+
+def measure(run, setup=None, repeat=5):
+    """Return the median seconds of run, calling setup untimed before every run"""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+def peakOf(name):
+    """Peak RSS in bytes of a fresh bench process that ran only the stage name, once"""
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--peak-of", name], capture_output=True, text=True, check=True).stdout
+    return int(output.split()[-1])
+
+def stagePeak(run, setup=None):
+    """Run a stage once in this process, returns its peak RSS in bytes. A stage that runs a
+    subprocess (import main) is measured by the subprocess, not by the bench around it."""
+    if setup:
+        setup()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    run()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss > children:
+        peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def stages(server, cachedir):
+    """Yield (name, run, setup) for every benchmarked stage"""
+    import standin
+    import main
+    import pilCalendar
+    import pilDraw
+    from pilDraw import dith_rounded_rectangle, textShortener, getFont
+    from pilWeather import drawWeather, get_weather_data
+    from PIL import Image, ImageDraw
+
+    # what every cron-style run pays before rendering: interpreter start and imports
+    coldstart = [sys.executable, "-c", "import main"]
+    yield "import main", lambda: subprocess.run(coldstart, env=dict(os.environ, PYTHONPATH=os.path.join(ROOT, "src")), check=True), None
+
+    main.getTagdata()
+    mac = os.environ["MAC"]
+    tagaccent = main.hwtypedict[main.tagdict[mac]][2]
+    canvas = Image.new("P", (800, 480))
+    draw = ImageDraw.Draw(canvas)
+    font = getFont(os.environ["CALENDAR_FONT"], 13)
+
+    yield "dith_rounded_rectangle[header]", lambda: dith_rounded_rectangle(draw, ((1, 1), (499, 47)), 10, fill=5, outline=1, width=2), None
+    yield "dith_rounded_rectangle[event]", lambda: dith_rounded_rectangle(draw, ((2, 60), (148, 120)), 6, fill=2, outline=1, width=1), None
+    title = "Architecture review with the platform and infrastructure teams and a very long agenda"
+    yield "textShortener", lambda: textShortener(draw, 130, title, font), None
+    yield "drawHeader", lambda: main.drawHeader(tagaccent), None
+    yield "get_weather_data", get_weather_data, None
+    weather_data = get_weather_data()
+    yield "drawWeather", lambda: drawWeather(tagaccent, weather_data), None
+    def coldSprites():
+        # every label shaped and rasterized again, as on the first render of a process
+        pilDraw.sprites.clear()
+        pilDraw.sprite_bytes = 0
+    yield "drawWeather[cold sprites]", lambda: drawWeather(tagaccent, weather_data), coldSprites
+
+    def coldCalendar():
+        # forget the synced stores so every run is a full sync
+        pilCalendar.stores.clear()
+        pilCalendar.nosync.clear()
+        pilCalendar.principal = None
+        shutil.rmtree(cachedir, ignore_errors=True)
+    def coldPipeline():
+        shutil.rmtree(os.path.join(cachedir, "tiles"), ignore_errors=True)
+    def pipeline():
+        data = main.fetchData([mac])
+        main.displayUpload(mac, *main.tagData(data, mac))
+
+    for calendar_set in CALENDAR_SETS:
+        standin.useCalendar(server, calendar_set)
+        coldCalendar()
+        yield "getCalendarEvents[" + calendar_set + "]", pilCalendar.getCalendarEvents, coldCalendar
+        events = pilCalendar.getCalendarEvents()
+        yield "drawCalendar[" + calendar_set + "]", lambda: pilCalendar.drawCalendar(tagaccent, events), None
+        yield "displayUpload[" + calendar_set + "]", pipeline, coldPipeline
+
+    # another client edits and deletes events between two syncs: an incremental sync,
+    # and a full one when the server no longer knows the token
+    def changedCalendar(expire=False):
+        def setup():
+            standin.useCalendar(server, "typical")
+            coldCalendar()
+            pilCalendar.getCalendarEvents()
+            standin.changeCalendar(server, edited=["typical-review", "typical-standup"], deleted=["typical-dentist"])
+            if expire:
+                standin.expireTokens(server)
+        return setup
+    def syncChanges():
+        titles = {event.title for event in pilCalendar.getCalendarEvents()}
+        if "Dentist" in titles or "Daily standup (moved)" not in titles:
+            raise RuntimeError("The sync missed changes made on the stand-in")
+    yield "getCalendarEvents[changed]", syncChanges, changedCalendar()
+    yield "getCalendarEvents[expired token]", syncChanges, changedCalendar(expire=True)
+
+def report(results, baseline, tolerance):
+    """Print the results next to the baseline, returns the names of regressed stages"""
+    regressions = []
+    print(f"{'stage':36} {'time':>10} {'baseline':>10} {'ratio':>6} {'peak RSS':>10} {'baseline':>10}")
+    for name, (seconds, peak) in results.items():
+        base = baseline.get(name)
+        # baselines recorded before the RSS was measured have no comparable peak
+        if base is None or "rss" not in base:
+            print(f"{name:36} {seconds * 1000:8.2f}ms {'-':>10} {'-':>6} {peak / 2 ** 20:8.1f}MB {'-':>10}")
+            continue
+        ratio = seconds / base["time"] if base["time"] else 1
+        regressed = ratio > 1 + tolerance or peak > base["rss"] * (1 + tolerance)
+        if regressed:
+            regressions.append(name)
+        print(f"{name:36} {seconds * 1000:8.2f}ms {base['time'] * 1000:8.2f}ms {ratio:6.2f} {peak / 2 ** 20:8.1f}MB {base['rss'] / 2 ** 20:8.1f}MB" + ("  REGRESSION" if regressed else ""))
+    return regressions
+
+def run():
+    parser = argparse.ArgumentParser(description="Benchmark the OEPL-Dash render stages")
+    parser.add_argument("--baseline", default=os.path.join(BENCH, "baseline.json"))
+    parser.add_argument("--update", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per stage")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before a stage counts as regressed")
+    parser.add_argument("--stage", default="", help="only run stages whose name contains this")
+    parser.add_argument("--peak-of", help=argparse.SUPPRESS) # run this stage once and print its peak RSS
+    args = parser.parse_args()
+
+    sys.path[:0] = [BENCH, os.path.join(ROOT, "src")]
+    os.chdir(ROOT)
+    import standin
+    server = standin.start()
+    cachedir = tempfile.mkdtemp(prefix="oepl-bench-")
+    configure(server, cachedir)
+
+    results = {}
+    stdout = sys.stdout
+    try:
+        with open(os.devnull, "w") as devnull:
+            sys.stdout = devnull
+            for name, stage, setup in stages(server, cachedir):
+                if args.peak_of is not None:
+                    if name == args.peak_of:
+                        peak = stagePeak(stage, setup)
+                        break
+                elif args.stage in name:
+                    results[name] = (measure(stage, setup, args.repeat), peakOf(name))
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(cachedir, ignore_errors=True)
+    if args.peak_of is not None:
+        print(peak)
+        return 0
+
+    try:
+        with open(args.baseline) as baselinefile:
+            baseline = json.load(baselinefile)
+    except OSError:
+        baseline = {}
+    regressions = report(results, baseline, args.tolerance)
+    if args.update:
+        baseline.update({name: {"time": seconds, "rss": peak} for name, (seconds, peak) in results.items()})
+        with open(args.baseline, "w") as baselinefile:
+            json.dump(baseline, baselinefile, indent=1, sort_keys=True)
+        print("Baseline written to " + args.baseline)
+        return 0
+    if regressions:
+        print(str(len(regressions)) + " stage(s) regressed: " + ", ".join(regressions))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,157 @@
+"""Local stand-in for the OpenEPaperLink AP, Open-Meteo and a CalDAV server, serving the recorded fixtures.
+
+    /current/tagDB.json, /tagtypes/XX.json, POST /imgupload   the AP
+    /v1/forecast                                              Open-Meteo
+    /dav/...                                                  CalDAV with sync-collection and multiget
+
+The calendar is read from fixtures/calendar-<name>.ics, with {DAY0}, {DAY1} and {DAY2}
+replaced by today and the next two days, so the events always fall in the dashboard's window.
+changeCalendar edits and deletes events as another client would; every change is logged, so a
+sync-collection with an earlier token gets the events changed since (deleted ones as 404s).
+Tokens of another calendar set or from before expireTokens are refused with valid-sync-token.
+"""
+import os
+import re
+import threading
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+CALENDAR_NAMES = ["Calendar 1"]
+
+def loadEvents(name):
+    """Split a fixture ICS into one VCALENDAR per event, keyed by UID"""
+    with open(os.path.join(FIXTURES, "calendar-" + name + ".ics")) as icsfile:
+        ics = icsfile.read()
+    today = date.today()
+    for day in range(3):
+        ics = ics.replace("{DAY" + str(day) + "}", (today + timedelta(days=day)).strftime("%Y%m%d"))
+    header = "BEGIN:VCALENDAR\nVERSION:2.0\nPRODID:-//OEPL-Dash//bench fixtures//EN\n"
+    events = {}
+    for vevent in re.findall(r"BEGIN:VEVENT\n.*?END:VEVENT\n", ics, re.S):
+        uid = re.search(r"^UID:(.*)$", vevent, re.M).group(1)
+        events[uid] = header + vevent + "END:VCALENDAR\n"
+    return events
+
+class StandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, content_type="application/json"):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def readBody(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0))).decode(errors="replace")
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/current/tagDB.json" or path.startswith("/tagtypes/") or path == "/v1/forecast":
+            fixture = {"/current/tagDB.json": "tagDB.json", "/v1/forecast": "openmeteo.json"}.get(path, path.lstrip("/"))
+            try:
+                with open(os.path.join(FIXTURES, fixture), "rb") as fixturefile:
+                    return self.reply(200, fixturefile.read())
+            except OSError:
+                pass
+        self.reply(404, "")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/imgupload":
+            self.server.uploads.append(len(body))
+            return self.reply(200, "Upload successful", "text/plain")
+        self.reply(404, "")
+
+    # CalDAV
+    def multistatus(self, responses, extra=""):
+        body = '<?xml version="1.0" encoding="utf-8"?>\n<d:multistatus xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav">'
+        for href, props in responses:
+            if props is None:
+                # gone, as reported by sync-collection
+                body += "<d:response><d:href>" + href + "</d:href><d:status>HTTP/1.1 404 Not Found</d:status></d:response>"
+                continue
+            body += "<d:response><d:href>" + href + "</d:href><d:propstat><d:prop>" + props + "</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>"
+        self.reply(207, body + extra + "</d:multistatus>", "application/xml; charset=utf-8")
+
+    def do_PROPFIND(self):
+        body = self.readBody()
+        if "current-user-principal" in body:
+            return self.multistatus([(self.path, "<d:current-user-principal><d:href>/dav/principal/</d:href></d:current-user-principal>")])
+        if "calendar-home-set" in body:
+            return self.multistatus([(self.path, "<c:calendar-home-set><d:href>/dav/calendars/</d:href></c:calendar-home-set>")])
+        if self.path.rstrip("/") == "/dav/calendars":
+            responses = [("/dav/calendars/", "<d:resourcetype><d:collection/></d:resourcetype><d:displayname>home</d:displayname>")]
+            for index, name in enumerate(CALENDAR_NAMES):
+                responses.append(("/dav/calendars/" + self.server.calendar_set + str(index) + "/", "<d:resourcetype><d:collection/><c:calendar/></d:resourcetype><d:displayname>" + name + "</d:displayname>"))
+            return self.multistatus(responses)
+        self.multistatus([(self.path, "<d:displayname>" + CALENDAR_NAMES[0] + "</d:displayname><d:resourcetype><d:collection/><c:calendar/></d:resourcetype>")])
+
+    def do_REPORT(self):
+        body = self.readBody()
+        base = self.path if self.path.endswith("/") else self.path + "/"
+        events = self.server.calendar_events
+        if "sync-collection" in body:
+            prefix = syncToken(self.server, "")
+            token = re.search(r"<[^>]*sync-token>([^<]*)</", body)
+            token = token.group(1) if token else ""
+            if not token:
+                uids = list(events)
+            elif token.startswith(prefix) and token[len(prefix):].isdigit() and int(token[len(prefix):]) <= len(self.server.calendar_changes):
+                # every event changed since the token, once
+                uids = list(dict.fromkeys(self.server.calendar_changes[int(token[len(prefix):]):]))
+            else:
+                return self.reply(403, '<?xml version="1.0" encoding="utf-8"?>\n<d:error xmlns:d="DAV:"><d:valid-sync-token/></d:error>', "application/xml; charset=utf-8")
+            responses = [(base + uid + ".ics", '<d:getetag>"' + str(hash(events[uid])) + '"</d:getetag>' if uid in events else None) for uid in uids]
+            return self.multistatus(responses, "<d:sync-token>" + syncToken(self.server, len(self.server.calendar_changes)) + "</d:sync-token>")
+        if "calendar-multiget" in body:
+            hrefs = re.findall(r"<[^>]*href>([^<]+)</", body)
+            uids = [href.rstrip("/").split("/")[-1][:-len(".ics")] for href in hrefs]
+        else:
+            uids = list(events)
+        self.multistatus([(base + uid + ".ics", '<d:getetag>"' + str(hash(events[uid])) + '"</d:getetag><c:calendar-data>' + events[uid].replace("&", "&amp;").replace("<", "&lt;") + "</c:calendar-data>") for uid in uids if uid in events])
+
+def start(calendar_set="typical"):
+    """Start the stand-in on a free local port, returns the server; its base url is server.url"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.uploads = []
+    server.url = "127.0.0.1:" + str(server.server_address[1])
+    useCalendar(server, calendar_set)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def useCalendar(server, calendar_set):
+    """Serve the events of fixtures/calendar-<calendar_set>.ics from now on"""
+    server.calendar_set = calendar_set
+    server.calendar_events = loadEvents(calendar_set)
+    server.calendar_changes = [] # UIDs in the order they were changed, a token is an index into it
+    server.token_epoch = getattr(server, "token_epoch", 0) + 1
+
+def syncToken(server, version):
+    return "http://standin/sync/" + server.calendar_set + "/" + str(server.token_epoch) + "/" + str(version)
+
+def changeCalendar(server, edited=(), deleted=()):
+    """Append " (moved)" to the titles of the events edited and delete the events deleted, both lists of UIDs"""
+    for uid in edited:
+        server.calendar_events[uid] = re.sub(r"^(SUMMARY:.*)$", r"\1 (moved)", server.calendar_events[uid], flags=re.M)
+    for uid in deleted:
+        del server.calendar_events[uid]
+    server.calendar_changes.extend(list(edited) + list(deleted))
+
+def expireTokens(server):
+    """Forget every sync token handed out so far, as servers do after a while"""
+    server.token_epoch += 1
+
+if __name__ == "__main__":
+    server = start()
+    print("Stand-in listening on http://" + server.url + " (ACCESSPOINTIP=" + server.url + ", WEATHER_URL=http://" + server.url + "/v1/forecast, CALDAV_URL=http://" + server.url + "/dav/)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
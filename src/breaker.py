@@ -0,0 +1,32 @@
+import time
+import metrics
+
+class CircuitBreaker:
+    """Stop calling a data source that keeps failing. After `failures` failures in a row the breaker
+    opens and the source is skipped for `cooldown` seconds; then a single call is let through again,
+    which closes the breaker when it succeeds and reopens it when it fails."""
+
+    def __init__(self, name, failures, cooldown):
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self.failed = 0 # failures in a row
+        self.open_until = 0 # monotonic time the source is skipped until
+
+    def allow(self):
+        if time.monotonic() < self.open_until:
+            metrics.count(self.name + "_breaker_skips")
+            return False
+        return True
+
+    def success(self):
+        self.failed = 0
+        self.open_until = 0
+
+    def failure(self):
+        self.failed += 1
+        # still at or above the threshold after the cooldown, so a failed retry reopens it at once
+        if self.failed >= self.failures:
+            print("Skipping " + self.name + " for " + str(self.cooldown) + "s after " + str(self.failed) + " failures in a row")
+            metrics.count(self.name + "_breaker_opened")
+            self.open_until = time.monotonic() + self.cooldown
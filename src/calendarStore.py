@@ -0,0 +1,242 @@
+import json
+import os
+import re
+from datetime import datetime, timedelta
+import pytz
+import vobject
+from caldav.elements import dav
+from caldav.lib import error
+
+CONTENT_LINE = re.compile(r'([A-Za-z0-9-]+)((?:;[^:;=]+=(?:"[^"]*"|[^:;"])*)*):(.*)')
+PARAMETER = re.compile(r';([^:;=]+)=((?:"[^"]*"|[^:;"])*)')
+DURATION = re.compile(r'([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+DRAWN_PROPERTIES = {"DTSTART", "DTEND", "DURATION", "SUMMARY"}
+
+class CalendarStore:
+    """Local copy of one CalDAV calendar.
+
+    The copy is kept current with sync-collection reports (RFC 6578), so a sync only
+    downloads the events that changed since the last sync token. Window queries are
+    answered from a date index instead of the server."""
+
+    def __init__(self, calendar, path, timezone):
+        self.calendar = calendar
+        self.path = path
+        self.timezone = pytz.timezone(timezone)
+        self.sync_token = None
+        self.objects = {}    # url: (etag, ics data)
+        self.single = {}     # url: [(start, end, name)]
+        self.recurring = {}  # url: [(vevent, recurrence ids overridden by other vevents)]
+        self.index = {}      # date: set of urls with a single event on that date
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as storefile:
+                stored = json.load(storefile)
+        except (OSError, ValueError):
+            return
+        self.sync_token = stored["sync_token"]
+        for url, (etag, data) in stored["objects"].items():
+            self.add(url, etag, data)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w") as storefile:
+            json.dump({"sync_token": self.sync_token, "objects": self.objects}, storefile)
+        os.replace(self.path + ".tmp", self.path)
+
+    def sync(self):
+        """Fetch the events changed or deleted since the last sync, returns the number of changes"""
+        try:
+            updates = self.calendar.objects_by_sync_token(self.sync_token, load_objects=False)
+        except error.DAVError:
+            if self.sync_token is None:
+                raise
+            # the server no longer knows our token, start over with a full sync
+            self.sync_token = None
+            return self.sync()
+
+        full = self.sync_token is None
+        listed = set()
+        changed = []
+        for obj in updates:
+            url = str(obj.url.canonical())
+            listed.add(url)
+            etag = obj.props.get(dav.GetEtag.tag)
+            if etag is None or url not in self.objects or self.objects[url][0] != etag:
+                changed.append((url, etag, obj))
+
+        # one multiget for every changed event, urls missing from the answer were deleted
+        loaded = {}
+        if changed:
+            for event in self.calendar.calendar_multiget([obj.url for url, etag, obj in changed]):
+                loaded[str(event.url.canonical())] = event.data
+        deleted = {url for url, etag, obj in changed if not loaded.get(url)}
+        for url, etag, obj in changed:
+            if url not in deleted:
+                self.add(url, etag, loaded[url])
+        # a full sync lists every event, so anything we still have that wasn't listed is gone
+        if full:
+            deleted |= self.objects.keys() - listed
+        for url in deleted:
+            self.remove(url)
+
+        self.sync_token = updates.sync_token
+        if changed or deleted or full:
+            self.save()
+        return len(changed)
+
+    def localDate(self, value):
+        if isinstance(value, datetime):
+            if value.tzinfo is None:
+                value = pytz.timezone("GMT").localize(value)
+            return value.astimezone(self.timezone).date()
+        return value
+
+    def add(self, url, etag, data):
+        self.remove(url)
+        self.objects[url] = (etag, data)
+        try:
+            single, recurring = readEvents(data)
+        except Exception as e:
+            print("Skipping unreadable event " + url + ": " + str(e))
+            return
+        if recurring:
+            self.recurring[url] = recurring
+        if single:
+            self.single[url] = single
+            for day in self.days(single):
+                self.index.setdefault(day, set()).add(url)
+
+    def remove(self, url):
+        self.objects.pop(url, None)
+        self.recurring.pop(url, None)
+        for day in self.days(self.single.pop(url, [])):
+            self.index[day].discard(url)
+
+    def days(self, events):
+        """Every local date the events touch, all-day end dates are exclusive"""
+        for start, end, name in events:
+            first, last = self.localDate(start), self.localDate(end)
+            if not isinstance(end, datetime) and last > first:
+                last -= timedelta(days=1)
+            for offset in range((last - first).days + 1):
+                yield first + timedelta(days=offset)
+
+    def between(self, first_day, last_day):
+        """Return (start, end, name) for every event touching the dates first_day to last_day"""
+        urls = set()
+        for offset in range((last_day - first_day).days + 1):
+            urls |= self.index.get(first_day + timedelta(days=offset), set())
+        events = []
+        # in url order, a set's order changes with every process and would change the drawn order
+        for url in sorted(urls):
+            for event in self.single[url]:
+                if any(first_day <= day <= last_day for day in self.days([event])):
+                    events.append(event)
+        for url in sorted(self.recurring):
+            for vevent, overridden in self.recurring[url]:
+                events.extend(expandEvent(vevent, overridden, first_day, last_day, self.timezone))
+        return events
+
+def readEvents(data):
+    """Return ([(start, end, name)], [(vevent, overridden recurrence ids)]) for the VEVENTs of an
+    iCalendar object. Only the drawn properties are read; vobject parses the whole object
+    only when it has recurrence rules or a timezone pytz doesn't know."""
+    single = scanEvents(data)
+    if single is not None:
+        return single, []
+    vevents = vobject.readOne(data).contents.get("vevent", [])
+    single = []
+    recurring = []
+    overridden = {vevent.recurrence_id.value for vevent in vevents if hasattr(vevent, "recurrence_id")}
+    for vevent in vevents:
+        if hasattr(vevent, "rrule") or hasattr(vevent, "rdate"):
+            recurring.append((vevent, overridden))
+            continue
+        start = vevent.dtstart.value
+        single.append((start, eventEnd(vevent, start), vevent.summary.value if hasattr(vevent, "summary") else ""))
+    return single, recurring
+
+def scanEvents(data):
+    """The (start, end, name) of every VEVENT from a line scan, None if the object needs vobject"""
+    events = []
+    properties = None # drawn properties of the VEVENT being scanned
+    depth = 0 # components nested in that VEVENT, like VALARMs
+    for line in re.sub(r"\r?\n[ \t]", "", data).splitlines():
+        match = CONTENT_LINE.match(line)
+        if match is None:
+            continue
+        name, parameters, value = match.group(1).upper(), match.group(2), match.group(3)
+        if name == "BEGIN":
+            if properties is not None:
+                depth += 1
+            elif value.upper() == "VEVENT":
+                properties = {}
+        elif name == "END":
+            if depth:
+                depth -= 1
+            elif properties is not None:
+                event = scannedEvent(properties)
+                if event is None:
+                    return None
+                events.append(event)
+                properties = None
+        elif properties is not None and not depth:
+            if name in ("RRULE", "RDATE"):
+                return None
+            if name in DRAWN_PROPERTIES:
+                properties[name] = ({key.upper(): parameter.strip('"') for key, parameter in PARAMETER.findall(parameters)}, value)
+    return events
+
+def scannedEvent(properties):
+    try:
+        start = scannedDate(*properties["DTSTART"])
+        if "DTEND" in properties:
+            end = scannedDate(*properties["DTEND"])
+        elif "DURATION" in properties:
+            sign, weeks, days, hours, minutes, seconds = DURATION.match(properties["DURATION"][1].strip()).groups()
+            duration = timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0), minutes=int(minutes or 0), seconds=int(seconds or 0))
+            end = start - duration if sign == "-" else start + duration
+        else:
+            end = start if isinstance(start, datetime) else start + timedelta(days=1)
+    except (KeyError, ValueError, AttributeError, pytz.UnknownTimeZoneError):
+        return None
+    name = re.sub(r"\\([\\;,nN])", lambda escape: "\n" if escape.group(1) in "nN" else escape.group(1), properties.get("SUMMARY", ({}, ""))[1])
+    return (start, end, name)
+
+def scannedDate(parameters, value):
+    value = value.strip()
+    if parameters.get("VALUE", "").upper() == "DATE" or len(value) == 8:
+        return datetime.strptime(value, "%Y%m%d").date()
+    if value.endswith(("Z", "z")):
+        return pytz.utc.localize(datetime.strptime(value[:-1], "%Y%m%dT%H%M%S"))
+    value = datetime.strptime(value, "%Y%m%dT%H%M%S")
+    if "TZID" in parameters:
+        return pytz.timezone(parameters["TZID"]).localize(value)
+    return value
+
+def expandEvent(vevent, overridden, first_day, last_day, timezone):
+    """Yield (start, end, name) for every occurrence of a recurring vevent touching first_day to last_day"""
+    start = vevent.dtstart.value
+    duration = eventEnd(vevent, start) - start
+    window_start = datetime.combine(first_day, datetime.min.time()) - duration
+    window_end = datetime.combine(last_day, datetime.max.time())
+    if isinstance(start, datetime) and start.tzinfo is not None:
+        window_start, window_end = timezone.localize(window_start), timezone.localize(window_end)
+    name = vevent.summary.value if hasattr(vevent, "summary") else ""
+    for occurrence in vevent.getrruleset(addRDate=True).between(window_start, window_end, inc=True):
+        if not isinstance(start, datetime):
+            occurrence = occurrence.date()
+        if occurrence in overridden:
+            continue
+        yield (occurrence, occurrence + duration, name)
+
+def eventEnd(vevent, start):
+    if hasattr(vevent, "dtend"):
+        return vevent.dtend.value
+    if hasattr(vevent, "duration"):
+        return start + vevent.duration.value
+    # RFC 5545: without an end, all-day events last one day and timed events are instants
+    return start if isinstance(start, datetime) else start + timedelta(days=1)
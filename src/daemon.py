@@ -0,0 +1,65 @@
+import random
+import signal
+import threading
+import time
+from datetime import datetime
+import main
+import metrics
+
+refresh_lock = threading.Lock()
+stop = threading.Event()
+planned = None # monotonic time of the next change of the screen, planned by the last refresh
+
+def refresh():
+    """Run one refresh, unless the previous one is still running"""
+    global planned
+    if not refresh_lock.acquire(blocking=False):
+        print("Previous refresh still running, skipping this one")
+        return
+    try:
+        # the plan of the last refresh is replaced by this one's, or dropped if it fails
+        planned = None
+        started = time.monotonic()
+        # cheap while the tagDB cache is fresh
+        with metrics.span("tagdata"):
+            main.getTagdata()
+        _, change = main.renderFleet(main.getFleet())
+        # a second late, so the clock has turned when the tags are rendered
+        planned = None if change is None else time.monotonic() + (change - datetime.now()).total_seconds() + 1
+        print(f"Refresh finished in {time.monotonic() - started:.1f}s")
+    except Exception as e:
+        print("Refresh failed: " + str(e))
+    finally:
+        refresh_lock.release()
+
+def run():
+    interval = main.settings.refresh_interval
+    jitter = main.settings.refresh_jitter
+    min_interval = main.settings.refresh_min_interval
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    print(f"Refreshing when the screen changes, at least every {interval}s (+/- {jitter}s) and at most every {min_interval}s")
+
+    while not stop.is_set():
+        started = time.monotonic()
+        # refreshes run in their own thread so a slow one can't push back the next poll for new data
+        worker = threading.Thread(target=refresh, daemon=True)
+        worker.start()
+        next_poll = started + interval + random.uniform(-jitter, jitter)
+        worker.join(max(next_poll - time.monotonic(), 0))
+        # the screen changes on its own at the planned time (midnight, the next hour, sunrise...),
+        # unjittered so it isn't stale; every refresh also polls, so the poll interval starts over
+        wake = next_poll
+        if planned is not None:
+            wake = min(wake, max(planned, started + min_interval))
+            print(f"Next refresh in {wake - time.monotonic():.0f}s")
+        stop.wait(max(wake - time.monotonic(), 1))
+    # let a running refresh finish its upload before exiting
+    with refresh_lock:
+        pass
+    main.shutdownPool()
+
+if __name__ == "__main__":
+    try:
+        run()
+    except KeyboardInterrupt:
+        pass
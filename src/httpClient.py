@@ -0,0 +1,69 @@
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from settings import settings
+
+sessions = {} # (host, retry_reads): keep-alive session
+limits = {} # host: semaphore bounding the requests in flight to it
+sessions_lock = threading.Lock()
+
+def hostOf(url):
+    return urlsplit(url).netloc
+
+def timeouts():
+    """(connect, read) timeout in seconds for every request that doesn't set its own"""
+    return settings.http_connect_timeout, settings.http_read_timeout
+
+def hostConcurrency():
+    return settings.http_host_concurrency
+
+def getSession(host, retry_reads=True):
+    """The pooled session for host. Connection errors are retried for every method,
+    error responses (429, 5xx) and, with retry_reads, read timeouts only for idempotent ones,
+    with exponential backoff."""
+    key = (host, retry_reads)
+    with sessions_lock:
+        if key not in sessions:
+            retry = Retry(
+                total=settings.http_retries,
+                read=None if retry_reads else 0,
+                backoff_factor=settings.http_backoff,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(max_retries=retry, pool_maxsize=hostConcurrency())
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            sessions[key] = session
+        return sessions[key]
+
+def hostLimit(host):
+    limit = limits.get(host)
+    if limit is None:
+        with sessions_lock:
+            limit = limits.setdefault(host, threading.BoundedSemaphore(hostConcurrency()))
+    return limit
+
+def request(method, url, retry_reads=True, **kwargs):
+    """requests.request through the pooled session of url's host, within the host's concurrency limit.
+    The timeouts are per attempt; callers with a fallback of their own pass retry_reads=False, so a
+    server that accepts but doesn't answer costs them one read timeout instead of HTTP_RETRIES + 1."""
+    host = hostOf(url)
+    kwargs.setdefault("timeout", timeouts())
+    with hostLimit(host):
+        return getSession(host, retry_reads).request(method, url, **kwargs)
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+def reset():
+    """Forget the pooled connections and limits, forked workers must not share the parent's sockets"""
+    with sessions_lock:
+        sessions.clear()
+        limits.clear()
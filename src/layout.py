@@ -0,0 +1,58 @@
+from functools import lru_cache
+
+# Smaller text can't be read on the tags, however small the widget gets
+MIN_FONT_SIZE = 10
+
+# The dashboard as designed per tag shape: name: ((design width, design height), {widget: (left, top, right, bottom)}).
+# A tag gets the regions of its shape scaled to its width and height.
+LAYOUTS = {
+    "landscape": ((800, 480), {
+        "header": (0, 0, 500, 48),
+        "calendar": (500, 0, 800, 480),
+        "weather": (0, 48, 500, 478),
+    }),
+    # the widgets stacked, the calendar's day columns across the full width
+    "portrait": ((480, 800), {
+        "header": (0, 0, 480, 48),
+        "weather": (0, 48, 480, 478),
+        "calendar": (0, 478, 480, 800),
+    }),
+    # tags too narrow for the calendar's day columns only show the date and the weather
+    "compact": ((500, 300), {
+        "header": (0, 0, 500, 48),
+        "weather": (0, 48, 500, 298),
+    }),
+    "narrow": ((150, 300), {
+        "header": (0, 0, 150, 24),
+        "weather": (0, 24, 150, 300),
+    }),
+}
+# narrowest tag that gets a calendar
+CALENDAR_MIN_WIDTH = 400
+
+def layoutName(width, height):
+    """The region set for a tag of this size"""
+    if height > width:
+        return "portrait" if width >= CALENDAR_MIN_WIDTH else "narrow"
+    return "landscape" if width >= CALENDAR_MIN_WIDTH else "compact"
+
+@lru_cache(maxsize=None)
+def tagLayout(width, height):
+    """Return {widget: (x, y, width, height)} for a tag of this size, computed once per size.
+    Widgets missing from the tag's region set are not drawn on it."""
+    (design_width, design_height), regions = LAYOUTS[layoutName(width, height)]
+    scalex, scaley = width / design_width, height / design_height
+    boxes = {}
+    for widget, (left, top, right, bottom) in regions.items():
+        x, y = round(left * scalex), round(top * scaley)
+        boxes[widget] = (x, y, round(right * scalex) - x, round(bottom * scaley) - y)
+    return boxes
+
+def scaler(width, height, design_width, design_height):
+    """Return (x, y, size, font) functions turning a widget's design pixels into pixels at width x height.
+    size scales radii with the more constrained axis, so they never outgrow their box;
+    font scales font sizes the same way, but not below MIN_FONT_SIZE."""
+    scalex, scaley = width / design_width, height / design_height
+    scale = min(scalex, scaley)
+    size = lambda value: max(1, round(value * scale))
+    return (lambda value: round(value * scalex)), (lambda value: round(value * scaley)), size, (lambda value: max(MIN_FONT_SIZE, size(value)))
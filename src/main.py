@@ -1,121 +1,285 @@
+import time
+import_started = time.perf_counter()
+import io
 import os
+import json
+import pickle
+import hashlib
+from functools import lru_cache
+import queue
+import threading
 import requests
-import configparser
-from pilWeather import drawWeather
-from pilCalendar import drawCalendar
-from datetime import datetime
-from PIL import Image, ImageDraw, ImageFont
-
-tagdict = {} # machash: (mac, hwtype)
-hwtypedict = {} # hwtype: (width, height)
-
-config = configparser.ConfigParser()
-config.read("config.ini")
-
-def getConfig(key, section='DEFAULT'):
-    # Check if the environment variable is set
-    env_value = os.getenv(key)
-    if env_value is not None:
-        return env_value
-    # If not set, return the value from the config file
-    return config.get(section, key)
-
-def getTagdata():
-    tagdb = requests.get("http://" + getConfig("ACCESSPOINTIP") + "/current/tagDB.json")
-    hwtypeset = set()
-    for tag in tagdb.json():
-        match tag:
-            case [{"mac": str() as mac, "hwType": int() as hwtype}]:
-                if hwtype >= 224:
-                    continue
-                tagdict[mac] = hwtype
-                hwtypeset.add(hwtype)
+import httpClient
+import metrics
+from breaker import CircuitBreaker
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from settings import settings
+from pilDraw import dith_rounded_rectangle, fromBackground, getFont
+from layout import MIN_FONT_SIZE, scaler, tagLayout
+from datetime import datetime, timedelta
+from PIL import Image, ImageDraw
+
+tagdict = {} # mac: hwtype
+tagap = {} # mac: the AP the tag is registered with
+hwtypedict = {} # hwtype: (width, height, accent colors, bits per pixel, buffer rotation)
+datasources = {} # source: fetch function taking the MACs to render, of the enabled widgets
+breakers = {} # source: CircuitBreaker, kept between refreshes of the daemon
+last_good = {} # source: data of its last successful fetch, also pickled to CACHE_DIR for later runs
+pool = None # ProcessPoolExecutor rendering the fleet, kept between refreshes of the daemon
+pool_key = None # (workers, tagdict, hwtypedict) the pool's workers were initialised with
+
+# a rendered image waiting for uploadImage
+Upload = namedtuple("Upload", ["mac", "filename", "encoded", "mimetype", "imagehash"])
+
+# widgets are only imported when enabled, the calendar pulls in caldav, vobject and pytz
+if "calendar" in settings.widgets:
+    from pilCalendar import drawCalendar, getCalendarEvents, calendarInputs, calendarChange
+    datasources["calendar"] = lambda macs: getCalendarEvents()
+if "weather" in settings.widgets:
+    from pilWeather import drawWeather, get_weather_batch, weatherInputs, weatherChange
+    datasources["weather"] = lambda macs: get_weather_batch([weatherLocation(mac) for mac in macs])
+
+metrics.setup(settings.metrics_log, settings.metrics_prom)
+metrics.gauge("import_seconds", time.perf_counter() - import_started)
+
+def cachedJson(url, cachefile, ttl=None, refresh=False):
+    """Return (json, fromcache) for url, served from the on-disk cache while it is younger than ttl seconds.
+    ttl None keeps the cached copy forever. A stale copy is still used when the AP can't be reached."""
+    path = os.path.join(settings.cache_dir, cachefile)
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        age = None
+    if age is not None and not refresh and (ttl is None or age < ttl):
+        metrics.count("metadata_cache_hits")
+        with open(path) as cache:
+            return json.load(cache), True
+    metrics.count("metadata_fetches")
+    try:
+        # the cached copy is the fallback, rather than waiting out a read timeout per retry
+        response = httpClient.get(url, retry_reads=False)
+        response.raise_for_status()
+        data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        if age is None:
+            raise
+        print("Could not fetch " + url + ", using the cached copy: " + str(e))
+        with open(path) as cache:
+            return json.load(cache), True
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as cache:
+        json.dump(data, cache)
+    os.replace(path + ".tmp", path)
+    return data, False
+
+def getConfiguredMacs():
+    """Return the MACs from the config, or None if every tag should be rendered"""
+    macs = settings.mac.strip()
+    if macs.lower() == "all":
+        return None
+    return [mac.strip() for mac in macs.split(",")]
+
+def getTagdata(refresh=False):
+    """Read the tagDB of every AP in ACCESSPOINTIP and map each tag to the AP that owns it.
+    An AP that can't be reached (and has no cached tagDB) is skipped, unless every AP is down."""
+    tags = {}
+    owners = {}
+    lastseen = {}
+    hwtypeaps = {} # hwtype: an AP to fetch its tagtype from
+    fromcache = False
+    failed = 0
+    for ap in settings.accesspointip:
+        try:
+            tagdb, cached = cachedJson("http://" + ap + "/current/tagDB.json", "tagDB-" + ap.replace(":", "_") + ".json", settings.tagdb_ttl, refresh)
+        except (requests.RequestException, ValueError) as e:
+            failed += 1
+            if failed == len(settings.accesspointip):
+                raise
+            print("Could not read the tagDB of " + ap + ", skipping its tags: " + str(e))
+            continue
+        fromcache = fromcache or cached
+        for tag in tagdb:
+            match tag:
+                case [{"mac": str() as mac, "hwType": int() as hwtype}]:
+                    if hwtype >= 224:
+                        continue
+                    # a tag that moved is still listed by its old AP, the one that saw it last owns it
+                    seen = tag[0].get("lastseen", 0)
+                    if mac in tags and seen <= lastseen[mac]:
+                        continue
+                    tags[mac], owners[mac], lastseen[mac] = hwtype, ap, seen
+                    hwtypeaps.setdefault(hwtype, ap)
+    # a configured tag missing from the cached tagDBs means the membership changed
+    configured = getConfiguredMacs()
+    if fromcache and not refresh and configured and not tags.keys() >= set(configured):
+        return getTagdata(refresh=True)
+    # replace the tags only once the tagDBs were read, so a refresh drops removed tags
+    tagdict.clear()
+    tagdict.update(tags)
+    tagap.clear()
+    tagap.update(owners)
     # with the set of hwtypes we get the hardware json files from the AP for the resolution data
-    for hwtype in hwtypeset:
+    for hwtype in hwtypeaps.keys() - hwtypedict.keys():
         hwfilename = str("%0.2X" % hwtype) + ".json"
-        typejson = requests.get("http://" + getConfig("ACCESSPOINTIP") + "/tagtypes/" + hwfilename)
-        match typejson.json():
+        # tagtypes never change for a hwtype, so they are cached forever
+        typejson, _ = cachedJson("http://" + hwtypeaps[hwtype] + "/tagtypes/" + hwfilename, "tagtypes/" + hwfilename)
+        match typejson:
             case {"width": int() as width, "height": int() as height, "colortable": dict() as colortable}:
                 accent = {k: v for k, v in colortable.items() if k in ['red', 'yellow']}
-                hwtypedict[hwtype] = (width, height, accent)
-
-def dith_rounded_rectangle(draw, xy, radius, fill=0, outline=None, width=1):
-    (x1, y1), (x2, y2) = xy
-    x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
-    # Create a mask image with rounded corners
-    mask = Image.new('L', (x2 - x1, y2 - y1), 0)
-    mask_draw = ImageDraw.Draw(mask)
-    mask_draw.rounded_rectangle((0, 0, x2 - x1, y2 - y1), radius, fill=255)
-
-    # Determine the fill color and whether it should be dithered
-    if fill > 2:
-        base_fill = fill - 3
-        dither = True
-    else:
-        base_fill = fill
-        dither = False
+                hwtypedict[hwtype] = (width, height, accent, typejson.get("bpp", 2), typejson.get("rotatebuffer", 0))
 
-    # Create a pattern for dithering
-    pattern = [
-        [base_fill, 0],
-        [0, base_fill]
-    ]
+def getFleet():
+    """Return the MACs to render: MAC may be a single tag, a comma separated list or 'all'"""
+    macs = getConfiguredMacs()
+    if macs is None:
+        return list(tagdict)
+    fleet = []
+    for mac in macs:
+        if mac not in tagdict:
+            print("Tag " + mac + " not found in the tagDB, skipping")
+            continue
+        fleet.append(mac)
+    return fleet
 
-    # Draw the dithered rectangle
-    for y in range(y1, y2):
-        for x in range(x1, x2):
-            if mask.getpixel((x - x1, y - y1)) == 255:
-                if dither:
-                    pattern_value = pattern[(y - y1) % 2][(x - x1) % 2]
-                    draw.point((x, y), fill=pattern_value)
-                else:
-                    draw.point((x, y), fill=base_fill)
-
-    # Draw the outline if specified
-    if outline is not None:
-        draw.rounded_rectangle((x1, y1, x2, y2), radius, outline=outline, width=width)
-
-def drawHeader():
-    mac = getConfig("MAC")
-    hwtype = tagdict[mac]
-    tagwidth, tagheight = hwtypedict[hwtype][0], hwtypedict[hwtype][1]
-    width, height = int(tagwidth * (5/8)), int(tagheight * 0.1)
-    tagaccent = hwtypedict[hwtype][2]
-    image = Image.new("P", (width, height))
+def headerInputs(tagaccent, width, height):
+    """Everything drawHeader's output depends on, for the tile cache"""
+    return (datetime.now().strftime("%d.%m.%Y"), tagaccent, width, height, settings.header_font)
+
+def headerChange(now):
+    """The next moment drawHeader's output changes: the date at midnight"""
+    return datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+
+@lru_cache(maxsize=None)
+def headerPlan(width, height):
+    """Font size, box and text position of the header at this size, scaled from its 500x48 design"""
+    x, y, size, font = scaler(width, height, 500, 48)
+    return {"font": font(34), "box": ((1, 1), (width - 1, height - 1)), "radius": size(10), "text": (x(15), y(4))}
+
+def drawHeader(tagaccent, width=500, height=48):
+    plan = headerPlan(width, height)
     palette = [
         255, 255, 255,
         0, 0, 0,
         next(iter(tagaccent.values()))[0], next(iter(tagaccent.values()))[1], next(iter(tagaccent.values()))[2]
     ]
-    image.putpalette(palette)
-    font = ImageFont.truetype(getConfig("HEADER_FONT"), 34)
+    font = getFont(settings.header_font, plan["font"])
+    # the dithered box is the same every day
+    image = fromBackground(("header", width, height), palette, lambda draw: dith_rounded_rectangle(draw, plan["box"], plan["radius"], fill=5, outline=1, width=2))
     draw = ImageDraw.Draw(image)
 
-    dith_rounded_rectangle(draw, ((1, 1), (499, 47)), 10, fill=5, outline=1, width=2)
     today = datetime.now().strftime("%d.%m.%Y")
-    draw.text((15, 4), today, fill=1, font=font)
+    draw.text(plan["text"], today, fill=1, font=font)
     # anything else here?
     return image
 
-def textShortener(draw, displaywidth, text, font):
-    textbounds = draw.textbbox((0, 0), text, font=font)
-    textlength = len(text)
-    trailingdot = ""
-    while textbounds[2] >= displaywidth:
-        textlength -= 1
-        textbounds = draw.textbbox((0, 0), text[:textlength], font=font)
-        trailingdot = "."
-    return text[:textlength] + trailingdot
-
-def displayUpload():
-    mac = getConfig("MAC")
+def cachedTile(widget, inputs, draw):
+    """Return the widget's tile for these inputs, calling draw only when no tile was stored for them.
+    Tiles are files named after a hash of the inputs, so fleet workers and later runs share them."""
+    tiledir = os.path.join(settings.cache_dir, "tiles")
+    path = os.path.join(tiledir, widget + "-" + hashlib.sha256(pickle.dumps(inputs)).hexdigest()[:32] + ".png")
+    try:
+        tile = Image.open(path)
+        tile.load()
+        os.utime(path)
+        print("Using cached " + widget + " tile")
+        metrics.count("tile_hits")
+        return tile
+    except OSError:
+        pass
+    print("Drawing " + widget)
+    metrics.count("tile_misses")
+    tile = draw()
+    os.makedirs(tiledir, exist_ok=True)
+    tile.save(path + "." + str(os.getpid()), "PNG")
+    os.replace(path + "." + str(os.getpid()), path)
+    # tiles unused for a day won't come back (their date is in the inputs)
+    for name in os.listdir(tiledir):
+        tilepath = os.path.join(tiledir, name)
+        try:
+            if time.time() - os.path.getmtime(tilepath) > 86400:
+                os.remove(tilepath)
+        except OSError:
+            pass
+    return tile
+
+def imageHash(image):
+    """Hash the palette image itself, so identical screens hash the same before any encoding"""
+    digest = hashlib.sha256()
+    digest.update(str(image.size).encode())
+    digest.update(bytes(image.getpalette()))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def hashPath(mac):
+    # with the other state in CACHE_DIR, so only exported images end up in ./current
+    return os.path.join(settings.cache_dir, "hash-" + mac)
+
+def getLastHash(mac):
+    try:
+        with open(hashPath(mac)) as hashfile:
+            return hashfile.read().strip()
+    except OSError:
+        return None
+
+def saveHash(mac, imagehash):
+    path = hashPath(mac)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as hashfile:
+        hashfile.write(imagehash)
+
+def packBitplanes(image, bpp, rotate=0):
+    """Pack the palette image into the tag's native buffer: one bit per pixel, rows MSB first,
+    the black plane followed by the accent plane on tags with more than 1 bpp"""
+    if rotate:
+        image = image.rotate(-90 * rotate, expand=True)
+    # the palette indexes are white 0, black 1 and accent 2
+    indexes = Image.frombytes("L", image.size, image.tobytes())
+    planes = [indexes.point([255 if index == 1 else 0 for index in range(256)], "1").tobytes()]
+    if bpp > 1:
+        planes.append(indexes.point([255 if index == 2 else 0 for index in range(256)], "1").tobytes())
+    return b"".join(planes)
+
+def encodeImage(image, imageformat, bpp=2, rotate=0):
+    """Encode the palette image in memory, PNG keeps the palette and is lossless, RAW is the tag's own bit planes"""
+    if imageformat == "RAW":
+        return packBitplanes(image, bpp, rotate)
+    buffer = io.BytesIO()
+    if imageformat == "PNG":
+        image.save(buffer, "PNG", optimize=True)
+    else:
+        image.convert('RGB').save(buffer, "JPEG", quality="maximum")
+    return buffer.getvalue()
+
+def markStale(image, box):
+    """Label a widget drawn from old data with a small "stale" in its top right corner"""
+    x, y, width, height = box
+    font = getFont(settings.header_font, max(MIN_FONT_SIZE, min(width, height) // 30))
+    draw = ImageDraw.Draw(image)
+    left, top, right, bottom = draw.textbbox((0, 0), "stale", font=font)
+    textx, texty = x + width - right - 4, y - top + 4
+    draw.rectangle((textx + left - 3, texty + top - 3, textx + right + 2, texty + bottom + 2), fill=0, outline=1)
+    draw.text((textx, texty), "stale", fill=1, font=font)
+
+def displayUpload(mac, calendar_events=None, weather_data=None, stale=frozenset()):
+    """Render and upload the dashboard of one tag, returns 'uploaded', 'skipped', 'exported' or 'failed'"""
+    rendered = renderImage(mac, calendar_events, weather_data, stale)
+    if not isinstance(rendered, Upload):
+        return rendered
+    result, taken = uploadImage(rendered)
+    metrics.merge(taken)
+    return result
+
+def renderImage(mac, calendar_events=None, weather_data=None, stale=frozenset()):
+    """Render the dashboard of one tag, returns 'skipped' or 'exported', or the Upload for uploadImage.
+    The widgets of the sources in stale are marked as drawn from old data."""
     hwtype = tagdict[mac]
     tagwidth = hwtypedict[hwtype][0]
     tagheight = hwtypedict[hwtype][1]
     tagaccent = hwtypedict[hwtype][2]
-    imagepath = "./current/" + mac + ".jpg"
-    payload = {"dither": 0, "mac": mac}
-    url = "http://" + getConfig("ACCESSPOINTIP") + "/imgupload"
+    imageformat = settings.upload_format
+    extension, mimetype = {"PNG": (".png", "image/png"), "RAW": (".raw", "application/octet-stream")}.get(imageformat, (".jpg", "image/jpeg"))
     print("Generating image for tag " + mac)
     image = Image.new('P', (tagwidth, tagheight))
     palette = [
@@ -125,25 +289,307 @@ def displayUpload():
     ]
     image.putpalette(palette)
 
-    print("Drawing Date")
-    image.paste(drawHeader())
-    print("Drawing calendar")
-    image.paste(drawCalendar(tagaccent), (500,0))
-    print("Drawing weather")
-    image.paste(drawWeather(tagaccent), (0, 48))
-
-    rgb_image = image.convert('RGB')
-    print("Exporting image to " + imagepath)
-    rgb_image.save(imagepath, 'JPEG', quality="maximum")
-    if getConfig("SKIPUPLOAD") == "False" or getConfig("SKIPUPLOAD") == "false":
-        print("Uploading to " + url)
-        files = {"file": open(imagepath, "rb")}
-        response = requests.post(url, data=payload, files=files)
+    # the widget boxes are computed once per tag size; only tiles whose inputs
+    # changed since they were last drawn are redrawn
+    boxes = tagLayout(tagwidth, tagheight)
+    if "header" in settings.widgets:
+        x, y, width, height = boxes["header"]
+        with metrics.span("render_header"):
+            image.paste(cachedTile("header", headerInputs(tagaccent, width, height), lambda: drawHeader(tagaccent, width, height)), (x, y))
+    # widgets whose data could not be fetched are left blank, those the tag's layout has no room for aren't drawn
+    if calendar_events is not None and "calendar" in boxes:
+        x, y, width, height = boxes["calendar"]
+        with metrics.span("render_calendar"):
+            image.paste(cachedTile("calendar", calendarInputs(tagaccent, calendar_events, width, height), lambda: drawCalendar(tagaccent, calendar_events, width, height)), (x, y))
+        if "calendar" in stale:
+            markStale(image, boxes["calendar"])
+    if weather_data is not None:
+        x, y, width, height = boxes["weather"]
+        with metrics.span("render_weather"):
+            image.paste(cachedTile("weather", weatherInputs(tagaccent, weather_data, width, height), lambda: drawWeather(tagaccent, weather_data, width, height)), (x, y))
+        if "weather" in stale:
+            markStale(image, boxes["weather"])
+
+    upload = not settings.skipupload
+    imagehash = imageHash(image)
+    if upload and not settings.force_refresh and imagehash == getLastHash(mac):
+        print("Image unchanged since the last upload, skipping tag " + mac)
+        return "skipped"
+
+    with metrics.span("encode"):
+        encoded = encodeImage(image, imageformat, *hwtypedict[hwtype][3:])
+    # the image only goes to disk for debugging, or when it isn't uploaded at all
+    if not upload or settings.save_image:
+        imagepath = "./current/" + mac + extension
+        print("Exporting image to " + imagepath)
+        os.makedirs("./current", exist_ok=True)
+        with open(imagepath, "wb") as imagefile:
+            imagefile.write(encoded)
+    if not upload:
+        return "exported"
+    return Upload(mac, mac + extension, encoded, mimetype, imagehash)
+
+def uploadImage(upload, deadline=None):
+    """Post a rendered image to the AP of its tag, returns 'uploaded' or 'failed' and the metrics of the upload.
+    While the AP is busy (429, 5xx) or too slow to answer, the post is retried HTTP_RETRIES times with
+    exponential backoff; connection errors are already retried by the session. Given the monotonic
+    deadline of the refresh, no attempt runs past it and no retry starts after it."""
+    ap = tagap[upload.mac]
+    url = "http://" + ap + (settings.raw_upload_path if settings.upload_format == "RAW" else "/imgupload")
+    payload = {"dither": 0, "mac": upload.mac}
+    files = {"file": (upload.filename, upload.encoded, upload.mimetype)}
+    taken = {"spans": {}, "counters": {"bytes_sent": len(upload.encoded)}}
+    result = "failed"
+    started = time.perf_counter()
+    for attempt in range(settings.http_retries + 1):
+        if attempt:
+            pause = settings.http_backoff * 2 ** (attempt - 1)
+            if deadline is not None and time.monotonic() + pause >= deadline:
+                print("Refresh budget used up, giving up on the upload to " + ap)
+                break
+            time.sleep(pause)
+        timeout = httpClient.timeouts()
+        if deadline is not None and time.monotonic() < deadline:
+            # the one tag started after the deadline gets a single attempt with the full timeouts
+            timeout = tuple(min(limit, deadline - time.monotonic()) for limit in timeout)
+        print("Uploading " + str(len(upload.encoded)) + " bytes to " + url)
+        taken["counters"]["upload_attempts"] = attempt + 1
+        try:
+            response = httpClient.post(url, data=payload, files=files, timeout=timeout)
+        except requests.ReadTimeout as e:
+            print("AP " + ap + " did not answer: " + str(e))
+            continue
+        except requests.RequestException as e:
+            print("Failed to upload the image: " + str(e))
+            break
+        taken["counters"]["upload_status"] = response.status_code
         if response.status_code == 200:
-            print("Image uploaded successfully to " + mac)
-        else:
+            print("Image uploaded successfully to " + upload.mac)
+            saveHash(upload.mac, upload.imagehash)
+            result = "uploaded"
+            break
+        if response.status_code != 429 and response.status_code < 500:
             print("Failed to upload the image.")
+            break
+        print("AP " + ap + " is busy (" + str(response.status_code) + ")")
+    taken["spans"]["upload"] = time.perf_counter() - started
+    return result, taken
+
+def initWorker(tags, hwtypes):
+    # spawned workers start with empty globals, so hand them the tag metadata
+    tagdict.update(tags)
+    hwtypedict.update(hwtypes)
+    # workers only render, but forked ones must not share the parent's pooled connections either
+    httpClient.reset()
+
+def getPool(workers):
+    """The process pool rendering the fleet. Its workers keep their fonts, backgrounds and sprites
+    from one refresh to the next, so it is only replaced when the tags or their types changed."""
+    global pool, pool_key
+    key = (workers, dict(tagdict), dict(hwtypedict))
+    if pool is None or key != pool_key:
+        shutdownPool()
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(tagdict, hwtypedict))
+        pool_key = key
+    return pool
+
+def shutdownPool():
+    global pool
+    if pool is not None:
+        pool.shutdown()
+        pool = None
+
+def weatherLocation(mac):
+    """The (latitude, longitude) of a tag, from WEATHER_LOCATIONS or else LATITUDE/LONGITUDE"""
+    return settings.weather_locations.get(mac, (settings.latitude, settings.longitude))
+
+def tagData(data, mac):
+    """Pick the calendar events, the weather and the sources drawn from old data of one tag from the data of fetchData"""
+    weather = data.get("weather")
+    return data.get("calendar"), weather.get(weatherLocation(mac)) if weather else None, data["stale"]
+
+def timedFetch(source, fetch, macs):
+    with metrics.span("fetch_" + source):
+        return fetch(macs)
+
+def startFetch(source, fetch, macs):
+    """Run timedFetch on a daemon thread, so a fetch that misses its deadline can't hold up the exit of
+    the process. Returns the thread and the dict its data or exception ends up in."""
+    outcome = {}
+    def run():
+        try:
+            outcome["data"] = timedFetch(source, fetch, macs)
+        except Exception as e:
+            outcome["error"] = e
+    thread = threading.Thread(target=run, name="fetch-" + source, daemon=True)
+    thread.start()
+    return thread, outcome
+
+def getBreaker(source):
+    if source not in breakers:
+        breakers[source] = CircuitBreaker(source, settings.breaker_failures, settings.breaker_cooldown)
+    return breakers[source]
+
+def lastGoodPath(source):
+    return os.path.join(settings.cache_dir, "lastgood-" + source + ".pickle")
+
+def getLastGood(source):
+    """The data of source's last successful fetch, of this or an earlier run, None if there never was one"""
+    if source not in last_good:
+        try:
+            with open(lastGoodPath(source), "rb") as cache:
+                last_good[source] = pickle.load(cache)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            last_good[source] = None
+    return last_good[source]
+
+def saveLastGood(source, data):
+    last_good[source] = data
+    path = lastGoodPath(source)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as cache:
+        pickle.dump(data, cache)
+    os.replace(path + ".tmp", path)
+
+def fetchData(macs):
+    """Run every data fetch for the tags in macs concurrently, returns {source: data} and under "stale"
+    the sources that got old data. Sources that fail, miss their <SOURCE>_DEADLINE (seconds, capped by
+    REFRESH_BUDGET) or are skipped by their circuit breaker get the data of their last successful fetch,
+    or None if there is none."""
+    started = time.monotonic()
+    fetches = {source: fetch for source, fetch in datasources.items() if getBreaker(source).allow()}
+    print("Fetching " + ", ".join(fetches))
+    running = {source: startFetch(source, fetch, macs) for source, fetch in fetches.items()}
+    data = {"stale": set()}
+    for source in datasources:
+        if source in running:
+            deadline = started + min(getattr(settings, source + "_deadline"), settings.refresh_budget)
+            thread, outcome = running[source]
+            # fetches that miss their deadline finish in the background, or die with the process
+            thread.join(max(0, deadline - time.monotonic()))
+            if thread.is_alive():
+                print("Fetching " + source + " missed its deadline")
+            elif "error" in outcome:
+                print("Fetching " + source + " failed: " + str(outcome["error"]))
+            else:
+                data[source] = outcome["data"]
+                getBreaker(source).success()
+                if data[source] is not None:
+                    saveLastGood(source, data[source])
+                continue
+            getBreaker(source).failure()
+        data[source] = getLastGood(source)
+        if data[source] is not None:
+            print("Drawing " + source + " from the last data fetched")
+            metrics.count(source + "_stale")
+            data["stale"].add(source)
+    return data
+
+def nextChange(data, now=None):
+    """The next moment any tag rendered from the data of fetchData changes even if the data doesn't,
+    None if no enabled widget changes by itself"""
+    now = now or datetime.now()
+    changes = []
+    if "header" in settings.widgets:
+        changes.append(headerChange(now))
+    if data.get("calendar") is not None:
+        changes.append(calendarChange(now))
+    for weather_data in (data.get("weather") or {}).values():
+        changes.append(weatherChange(weather_data, now))
+    return min(changes, default=None)
+
+def renderTag(mac, calendar_events, weather_data, stale):
+    """renderImage for one tag, returns what it rendered and the metrics recorded while rendering it"""
+    metrics.take()
+    rendered = renderImage(mac, calendar_events, weather_data, stale)
+    return rendered, metrics.take()
+
+def drainQueue(tags, render, mayStart, finish, deadline):
+    """Render and upload the tags queued for one AP one after another. Several of these run per AP, but
+    httpClient lets only HTTP_HOST_CONCURRENCY of their uploads to it run at once, so a busy or slow AP
+    holds up its own tags and at most one rendered image per drain waits for it.
+    render(mac) returns renderTag's result, mayStart() whether a tag is started within the refresh budget
+    and finish(mac, result, metrics) records a tag's result; uploads stop retrying at the deadline of the budget."""
+    while True:
+        try:
+            mac = tags.get_nowait()
+        except queue.Empty:
+            return
+        if not mayStart():
+            finish(mac, "late", {"spans": {}, "counters": {}})
+            continue
+        try:
+            rendered, taken = render(mac)
+            result = rendered
+            if isinstance(rendered, Upload):
+                result, uploaded = uploadImage(rendered, deadline)
+                metrics.merge(uploaded, taken)
+        except Exception as e:
+            print("Failed to render tag " + mac + ": " + str(e))
+            result, taken = "failed", {"spans": {}, "counters": {}}
+        finish(mac, result, taken)
+
+def renderFleet(macs):
+    """Render and upload every tag in macs, sharing one calendar fetch and one weather fetch for all their locations.
+    Returns the count of every result and nextChange of the data, to schedule the next refresh."""
+    if not macs:
+        print("No tags to render")
+        return {}, None
+    started = time.monotonic()
+    data = fetchData(macs)
+    run = metrics.take()
+    results = {"uploaded": 0, "skipped": 0, "exported": 0, "failed": 0, "late": 0}
+    tagmetrics = {}
+    results_lock = threading.Lock()
+    def finish(mac, result, taken):
+        with results_lock:
+            results[result] += 1
+            tagmetrics[mac] = dict(taken, result=result)
+    deadline = started + settings.refresh_budget
+    rendering = False # whether a tag of this refresh was started
+    def mayStart():
+        # the first tag is rendered anyway, with the data there is, even after slow fetches used up the budget
+        nonlocal rendering
+        with results_lock:
+            if rendering and time.monotonic() > deadline:
+                return False
+            rendering = True
+            return True
+
+    # one upload queue per AP; tags not started within REFRESH_BUDGET are left for the next refresh
+    queues = {}
+    for mac in macs:
+        queues.setdefault(tagap[mac], queue.Queue()).put(mac)
+    if len(macs) == 1:
+        drainQueue(queues[tagap[macs[0]]], lambda mac: renderTag(mac, *tagData(data, mac)), mayStart, finish, deadline)
+    else:
+        workers = min(len(macs), settings.fleet_workers or os.cpu_count() or 1)
+        print("Rendering " + str(len(macs)) + " tags for " + str(len(queues)) + " APs with " + str(workers) + " workers")
+        executor = getPool(workers)
+        def render(mac):
+            global pool_key
+            try:
+                return executor.submit(renderTag, mac, *tagData(data, mac)).result()
+            except BrokenProcessPool:
+                # a worker died, so start a new pool on the next refresh
+                pool_key = None
+                raise
+        # enough drains per AP to keep every worker rendering while its uploads run
+        perap = max(workers, httpClient.hostConcurrency())
+        drains = [threading.Thread(target=drainQueue, args=(tags, render, mayStart, finish, deadline)) for tags in queues.values() for _ in range(perap)]
+        for drain in drains:
+            drain.start()
+        for drain in drains:
+            drain.join()
+        late = results["late"]
+        if late:
+            print("Refresh budget used up, " + str(late) + " tags left for the next refresh")
+    print(", ".join(str(count) + " " + result for result, count in results.items()))
+    metrics.export(run, tagmetrics)
+    return results, nextChange(data)
 
-getTagdata()
-# drawCalendar().show()
-displayUpload()
+if __name__ == "__main__":
+    with metrics.span("tagdata"):
+        getTagdata()
+    renderFleet(getFleet())
+    shutdownPool()
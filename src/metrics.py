@@ -0,0 +1,96 @@
+import json
+import os
+import time
+from contextlib import contextmanager, nullcontext
+
+enabled = False
+jsonlog = "" # file the per-run JSON lines are appended to, "-" for stdout
+promfile = "" # Prometheus textfile, rewritten after every run
+spans = {} # stage: seconds, of the run or tag in progress
+counters = {} # name: value, of the run or tag in progress
+noop = nullcontext()
+
+def setup(log="", prom=""):
+    global enabled, jsonlog, promfile
+    jsonlog, promfile = log, prom
+    enabled = bool(log or prom)
+
+def span(stage):
+    """Time the with block as stage, a shared no-op when metrics are disabled"""
+    if not enabled:
+        return noop
+    return timedSpan(stage)
+
+@contextmanager
+def timedSpan(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans[stage] = spans.get(stage, 0) + time.perf_counter() - started
+
+def count(name, value=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + value
+
+def gauge(name, value):
+    if enabled:
+        counters[name] = value
+
+def merge(taken, record=None):
+    """Add spans and counters recorded apart, e.g. by another thread, to record or to the run or tag in progress"""
+    if record is None:
+        if not enabled:
+            return
+        record = {"spans": spans, "counters": counters}
+    for stage, seconds in taken["spans"].items():
+        record["spans"][stage] = record["spans"].get(stage, 0) + seconds
+    record["counters"].update(taken["counters"])
+
+def take():
+    """Return the spans and counters recorded so far and start over"""
+    taken = {"spans": dict(spans), "counters": dict(counters)}
+    spans.clear()
+    counters.clear()
+    return taken
+
+def export(run, tags):
+    """Write one run: run-level metrics and {mac: {"result": ..., "spans": ..., "counters": ...}}"""
+    if not enabled:
+        return
+    record = dict(run, time=time.time(), tags=tags)
+    if jsonlog == "-":
+        print(json.dumps(record))
+    elif jsonlog:
+        with open(jsonlog, "a") as logfile:
+            logfile.write(json.dumps(record) + "\n")
+    if promfile:
+        with open(promfile + ".tmp", "w") as prom:
+            prom.write(prometheus(record))
+        os.replace(promfile + ".tmp", promfile)
+
+def prometheus(record):
+    """Render a run in the Prometheus text exposition format"""
+    lines = {}
+    def add(name, labels, value, kind="gauge"):
+        name = "oepl_dash_" + name
+        if name not in lines:
+            lines[name] = ["# TYPE " + name + " " + kind]
+        labeltext = ",".join(key + '="' + str(labelvalue) + '"' for key, labelvalue in labels.items())
+        lines[name].append(name + ("{" + labeltext + "}" if labeltext else "") + " " + str(value))
+
+    add("last_run_timestamp_seconds", {}, record["time"])
+    for stage, seconds in record["spans"].items():
+        add("stage_seconds", {"stage": stage}, round(seconds, 6))
+    for name, value in record["counters"].items():
+        add(name, {}, value)
+    results = {}
+    for mac, tag in record["tags"].items():
+        results[tag["result"]] = results.get(tag["result"], 0) + 1
+        for stage, seconds in tag["spans"].items():
+            add("stage_seconds", {"stage": stage, "tag": mac}, round(seconds, 6))
+        for name, value in tag["counters"].items():
+            add(name, {"tag": mac}, value)
+    for result, number in results.items():
+        add("tags", {"result": result}, number)
+    return "\n".join(line for block in lines.values() for line in block) + "\n"
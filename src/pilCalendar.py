@@ -1,277 +1,284 @@
 import os
-import configparser
+import hashlib
 import caldav
+import heapq
+import threading
+from collections import namedtuple
 from datetime import datetime, timedelta
+from functools import lru_cache
 import pytz
-from PIL import Image, ImageDraw, ImageFont
-import copy
-import vobject
-
-config = configparser.ConfigParser()
-config.read("config.ini")
-
-def getConfig(key, section='DEFAULT'):
-    # Check if the environment variable is set
-    env_value = os.getenv(key)
-    if env_value is not None:
-        return env_value
-    # If not set, return the value from the config file
-    return config.get(section, key)
-
-def dith_rounded_rectangle(draw, xy, radius, fill=0, outline=None, width=1):
-    (x1, y1), (x2, y2) = xy
-    x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
-    # Create a mask image with rounded corners
-    mask = Image.new('L', (x2 - x1, y2 - y1), 0)
-    mask_draw = ImageDraw.Draw(mask)
-    mask_draw.rounded_rectangle((0, 0, x2 - x1, y2 - y1), radius, fill=255)
-
-    # Determine the fill color and whether it should be dithered
-    if fill > 2:
-        base_fill = fill - 3
-        dither = True
-    else:
-        base_fill = fill
-        dither = False
-
-    # Create a pattern for dithering
-    pattern = [
-        [base_fill, 0],
-        [0, base_fill]
-    ]
-
-    # Draw the dithered rectangle
-    for y in range(y1, y2):
-        for x in range(x1, x2):
-            if mask.getpixel((x - x1, y - y1)) == 255:
-                if dither:
-                    pattern_value = pattern[(y - y1) % 2][(x - x1) % 2]
-                    draw.point((x, y), fill=pattern_value)
-                else:
-                    draw.point((x, y), fill=base_fill)
-
-    # Draw the outline if specified
-    if outline is not None:
-        draw.rounded_rectangle((x1, y1, x2, y2), radius, outline=outline, width=width)
-
-def tzConvert(dt):
-    """Convert a datetime from GMT to CET."""
+from PIL import ImageDraw
+from caldav.elements import cdav, dav
+from caldav.elements.base import BaseElement, NamedBaseElement
+from caldav.lib.namespace import ns
+from calendarStore import CalendarStore, DRAWN_PROPERTIES, expandEvent, readEvents
+from pilDraw import dith_rounded_rectangle, fromBackground, getFont, textShortener
+from layout import scaler
+import httpClient
+from settings import settings
+import metrics
+
+principal = None # CalDAV principal, kept between refreshes of the daemon
+stores = {} # calendar url: CalendarStore
+nosync = set() # urls of calendars whose server doesn't support sync-collection
+calendar_lock = threading.Lock() # a fetch that missed its deadline may still be syncing the stores
+
+class CalendarProp(NamedBaseElement):
+    tag = ns("C", "prop")
+
+class CalendarAllcomp(BaseElement):
+    tag = ns("C", "allcomp")
+
+# one day of an event, as drawn; a tuple so it pickles and hashes cheaply for the tile cache
+Event = namedtuple("Event", ["start", "end", "title", "color", "allday"])
+
+@lru_cache(maxsize=None)
+def getTimezone(name):
+    return pytz.timezone(name)
+
+def tzConvert(dt, timezone):
+    """Convert a datetime to timezone, naive datetimes are taken as GMT."""
     if dt.tzinfo is None:
-        dt = pytz.timezone("GMT").localize(dt)
-    return dt.astimezone(pytz.timezone(getConfig("TIMEZONE")))
-
-def textShortener(draw, displaywidth, text, font):
-    textbounds = draw.textbbox((0, 0), text, font=font)
-    textlength = len(text)
-    trailingdot = ""
-    while textbounds[2] >= displaywidth:
-        textlength -= 1
-        textbounds = draw.textbbox((0, 0), text[:textlength], font=font)
-        trailingdot = "."
-    return text[:textlength] + trailingdot
-
-def drawCalendar(tagaccent):
-    client = caldav.DAVClient(getConfig("CALDAV_URL"), username=getConfig("CAL_USERNAME"), password=getConfig("CAL_PASSWORD"))
-    principal = client.principal()
-    calendars = principal.calendars()
-
-    datetime_events = []
-    date_only_events = []
-
-    calendars = (cal for cal in calendars if cal.name in getConfig("CALENDAR_NAME").split(","))
+        dt = pytz.utc.localize(dt)
+    return dt.astimezone(timezone)
+
+def getPrincipal():
+    global principal
+    if principal is None:
+        client = caldav.DAVClient(settings.caldav_url, username=settings.cal_username, password=settings.cal_password, timeout=httpClient.timeouts())
+        principal = client.principal()
+    return principal
+
+def getStore(cal):
+    url = str(cal.url)
+    if url not in stores:
+        path = os.path.join(settings.cache_dir, "calendar-" + hashlib.sha1(url.encode()).hexdigest()[:12] + ".json")
+        stores[url] = CalendarStore(cal, path, settings.timezone)
+    return stores[url]
+
+def windowQuery(start, end):
+    """calendar-query REPORT for the events between start and end, with recurrences expanded by the
+    server and only the drawn properties returned (RFC 4791 9.6). The recurrence properties and
+    timezones are still asked for, in case the server ignores the expansion."""
+    vevent = cdav.Comp("VEVENT") + [CalendarProp(name) for name in sorted(DRAWN_PROPERTIES) + ["RRULE", "RDATE", "EXDATE", "RECURRENCE-ID"]]
+    vtimezone = cdav.Comp("VTIMEZONE") + [cdav.Allprop(), CalendarAllcomp()]
+    data = cdav.CalendarData() + [cdav.Comp("VCALENDAR") + [CalendarProp("VERSION"), vevent, vtimezone], cdav.Expand(start, end)]
+    window = cdav.CompFilter("VCALENDAR") + (cdav.CompFilter("VEVENT") + cdav.TimeRange(start, end))
+    return cdav.CalendarQuery() + [dav.Prop() + data, cdav.Filter() + window]
+
+def getCalendarEvents():
+    """Fetch the events of the next CALENDAR_DAYS days as a list of Events"""
+    with calendar_lock:
+        return fetchCalendarEvents()
+
+def fetchCalendarEvents():
+    calendars = getPrincipal().calendars()
+
+    calendars = (cal for cal in calendars if cal.name in settings.calendar_name)
     if not calendars:
-        print(f"Calendar '{getConfig('CALENDAR_NAME')}' not found.")
+        print(f"Calendar '{','.join(settings.calendar_name)}' not found.")
         return
 
-    # Get the current date and the date for the next day
-    # today = datetime.now().date()
+    # the window starts today and lasts as many days as there are columns
     today = datetime.now().date()
-    tomorrow = today + timedelta(days=1)
-    day_after_tomorrow = today + timedelta(days=2)
-
-    # Define the time range for the events
-    start_time = datetime.combine(today, datetime.min.time())
-    end_time = datetime.combine(day_after_tomorrow, datetime.max.time())
+    last_day = today + timedelta(days=settings.calendar_days - 1)
+    timezone = getTimezone(settings.timezone)
+    start_time = timezone.localize(datetime.combine(today, datetime.min.time()))
+    end_time = timezone.localize(datetime.combine(last_day + timedelta(days=1), datetime.min.time()))
 
-    # Fetch events within the specified time range
+    # Fetch events within the specified time range, from the synced local store where the server supports it
     events = []
     for index, cal in enumerate(calendars):
-        calevents = cal.date_search(start=start_time, end=end_time)
-        for event in calevents:
-            events.append((event, int(getConfig("CALENDAR_COLOR").split(",")[index])))
-
-    # processing multiday events so that things stop exploding
-    processed_datetime_events = []
-    processed_dateonly_events = []
-    for event, color in events:
-        # print(f"preprocessing: summary: {event.vobject_instance.vevent.summary.value}, start:{event.vobject_instance.vevent.dtstart.value}, end:{event.vobject_instance.vevent.dtend.value}")
-        vevent = event.vobject_instance.vevent
-        start_time = vevent.dtstart.value
-        end_time = vevent.dtend.value
-
-        # datetime event check
-        if isinstance(start_time, datetime) and isinstance(end_time, datetime):
-            start_time = tzConvert(start_time)
-            end_time = tzConvert(end_time)
-
-            # multiday event check
-            if start_time.date() != end_time.date():
-                # create a copy for the first day (until midnight)
-                day1_end = datetime.combine(start_time.date(), datetime.max.time()).replace(tzinfo=start_time.tzinfo)
-
-                # create copy of original
-                event_copy1 = copy.copy(event)
-                event_copy1.vobject_instance = vobject.readOne(event.data)
-                event_copy1.vobject_instance.vevent.dtend.value = day1_end
-                processed_datetime_events.append((event_copy1, color))
-
-                # create copy for second day1
-                day2_start = datetime.combine(start_time.date() + timedelta(days=1), datetime.min.time()).replace(tzinfo=end_time.tzinfo)
-                if end_time > start_time + timedelta(days=2):
-                    day2_end = datetime.combine(start_time.date(), datetime.max.time().replace(tzinfo=end_time.tzinfo))
-                else:
-                    day2_end = end_time
-                event_copy2 = copy.copy(event)
-                event_copy2.vobject_instance = vobject.readOne(event.data)
-                event_copy2.vobject_instance.vevent.dtstart.value = day2_start
-                event_copy2.vobject_instance.vevent.dtend.value = day2_end
-
-                processed_datetime_events.append((event_copy2, color))
+        color = settings.calendar_color[index]
+        if str(cal.url) not in nosync:
+            try:
+                store = getStore(cal)
+                metrics.count("calendar_changes", store.sync())
+                events.extend((start, end, name, color) for start, end, name in store.between(today, last_day))
                 continue
-            # not multiday
-            processed_datetime_events.append((event, color))
+            except caldav.lib.error.DAVError as e:
+                print(f"Calendar '{cal.name}' can't be synced, searching it on every run instead: {e}")
+                nosync.add(str(cal.url))
+        for event in cal.search(xml=windowQuery(start_time, end_time), comp_class=caldav.Event):
+            single, recurring = readEvents(event.data)
+            for vevent, overridden in recurring:
+                # the server didn't expand this one
+                single.extend(expandEvent(vevent, overridden, today, last_day, timezone))
+            events.extend((start, end, name, color) for start, end, name in single)
+
+    return splitDays(events, today, last_day)
+
+def splitDays(events, first_day, last_day):
+    """Normalise (start, end, name, color) tuples into Events of at most one local day each,
+    clipped to first_day to last_day. Timed events come sorted by start, after the all-day ones;
+    ties are broken by end, title and color, so the same events always draw the same image."""
+    timezone = getTimezone(settings.timezone)
+    days = []
+    for start, end, name, color in events:
+        allday = not (isinstance(start, datetime) and isinstance(end, datetime))
+        if allday:
+            # the end date of all-day events is exclusive
+            last = end - timedelta(days=1) if end and end > start else start
+            for offset in range((min(last, last_day) - max(start, first_day)).days + 1):
+                day = max(start, first_day) + timedelta(days=offset)
+                days.append(Event(day, day + timedelta(days=1), name, color, True))
+            continue
+        start, end = tzConvert(start, timezone), tzConvert(end, timezone)
+        day = max(start.date(), first_day)
+        while day <= min(end.date(), last_day):
+            # every day but the last lasts until midnight
+            day_start = max(start, timezone.localize(datetime.combine(day, datetime.min.time())))
+            day_end = min(end, timezone.localize(datetime.combine(day, datetime.max.time())))
+            if day_start < day_end or start == end:
+                days.append(Event(day_start, day_end, name, color, False))
+            day += timedelta(days=1)
+    return sorted(days, key=lambda event: (not event.allday, event.start, event.end, event.title, event.color))
+
+def layoutColumns(events):
+    """Place overlapping timed events side by side, returns [(event, column, columns)].
+    A sweep over the events sorted by start hands every event the lowest column freed by
+    an event that already ended; all events of one overlapping group share its column count."""
+    placed = []
+    group = [] # indexes into placed of the overlapping group in progress
+    running = [] # heap of (end, column) of the events still running
+    free = [] # heap of columns freed within the group
+    columns = 0
+    for event in sorted(events, key=lambda event: (event.start, event.end)):
+        while running and running[0][0] <= event.start:
+            heapq.heappush(free, heapq.heappop(running)[1])
+        if not running:
+            # nothing is running anymore, so the group is closed
+            for index in group:
+                placed[index] = placed[index][:2] + (columns,)
+            group, free, columns = [], [], 0
+        if free:
+            column = heapq.heappop(free)
         else:
-            # This is a date-only (all-day) event
-                event_start_date = start_time
-                event_end_date = end_time
-
-                # For all-day events, the end date is exclusive, so we subtract one day
-                if event_end_date:
-                    event_end_date = event_end_date - timedelta(days=1)
-
-                # Check if event spans multiple days
-                if event_end_date and event_start_date != event_end_date:
-                    # Process each day of the multi-day all-day event
-                    event_copy1 = copy.copy(event)
-                    event_copy1.vobject_instance = vobject.readOne(event.data)
-                    event_copy1.vobject_instance.vevent.dtstart.value = event_start_date
-                    event_copy1.vobject_instance.vevent.dtend.value = event_start_date + timedelta(days=1)
-                    processed_dateonly_events.append((event_copy1, color))
-
-                    event_copy2 = copy.copy(event)
-                    event_copy2.vobject_instance = vobject.readOne(event.data)
-                    event_copy2.vobject_instance.vevent.dtstart.value = event_start_date + timedelta(days=1)
-                    event_copy2.vobject_instance.vevent.dtend.value = event_start_date + timedelta(days=2)
-                    processed_dateonly_events.append((event_copy2, color))
-                else:
-                    # Single day all-day event
-                    processed_dateonly_events.append((event, color))
-
-    #     print(f"summary: {event.vobject_instance.vevent.summary.value}, start:{event.vobject_instance.vevent.dtstart.value}, end:{event.vobject_instance.vevent.dtend.value}")
-
-    processed_datetime_events = sorted(processed_datetime_events, key=lambda event: event[0].vobject_instance.vevent.dtstart.value)
+            column = columns
+            columns += 1
+        heapq.heappush(running, (event.end, column))
+        group.append(len(placed))
+        placed.append((event, column, 0))
+    for index in group:
+        placed[index] = placed[index][:2] + (columns,)
+    return placed
+
+def calendarInputs(tagaccent, events, width=300, height=480):
+    """Everything drawCalendar's output depends on, for the tile cache"""
+    return (datetime.now().date(), settings.calendar_days, tagaccent, events, width, height, settings.calendar_font)
+
+def calendarChange(now):
+    """The next moment drawCalendar's output changes without new events: the window moves on at midnight.
+    Events are drawn for their whole day, so their starts and ends change nothing by themselves."""
+    return datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+
+@lru_cache(maxsize=None)
+def calendarPlan(width, height, days):
+    """Font size, grid and columns of the calendar at this size, scaled from its 300x480 design"""
+    _, y, size, font = scaler(width, height, 300, 480)
+    column_width = width // days
+    hour_height = height / 27
+    return {
+        "font": font(13),
+        "radius": size(6),
+        # the narrowest side by side box: both rounded corners and the first letters of the title
+        "min_box": 2 * size(6) + size(20),
+        "title_y": y(10),
+        "column_width": column_width,
+        "hour_height": hour_height,
+        # dotted hour lines from 01:00 on
+        "dots": [(x, i * hour_height) for i in range(4, 27) for x in range(0, width, 7)],
+        # narrow columns only fit the abbreviated day names
+        "dayformat": "%A" if column_width >= size(100) else "%a",
+    }
+
+def inset(width):
+    """Text margin inside an event box, smaller on the narrow boxes of many days or overlaps"""
+    return min(10, width // 5)
+
+def drawCalendar(tagaccent, events, width=300, height=480):
+    """Draw one column per day of the window from the events of getCalendarEvents"""
+    today = datetime.now().date()
+    days = [today + timedelta(days=offset) for offset in range(settings.calendar_days)]
+
     # drawing part
-    width, height = 300, 480
-    image = Image.new("P", (width, height))
+    plan = calendarPlan(width, height, len(days))
     palette = [
         255, 255, 255,
         0, 0, 0,
         next(iter(tagaccent.values()))[0], next(iter(tagaccent.values()))[1], next(iter(tagaccent.values()))[2]
     ]
-    image.putpalette(palette)
+    font = getFont(settings.calendar_font, plan["font"])
+    column_width = plan["column_width"]
+    hour_height = plan["hour_height"]
+    radius = plan["radius"]
+    titles = tuple(day.strftime(plan["dayformat"]) for day in days)
+
+    def drawGrid(draw):
+        draw.point(plan["dots"], fill=1)
+        draw.line((0, 1 * hour_height, width, 1 * hour_height), fill=1)
+        draw.line((0, 3 * hour_height, width, 3 * hour_height), fill=1)
+        for index, title in enumerate(titles):
+            if index > 0:
+                draw.line((index * column_width, 0, index * column_width, height), fill=1)
+            draw.text((index * column_width + column_width // 2, plan["title_y"]), title, fill=1, font=font, anchor='mm')
+
+    # the grid and day names only change with the weekday, so there are at most seven per size
+    image = fromBackground(("calendar", width, height, settings.calendar_font, titles), palette, drawGrid)
     draw = ImageDraw.Draw(image)
 
-    font = ImageFont.truetype(getConfig("CALENDAR_FONT"), 13)
-    column_width = width // 2
-    hour_height = height / 27
-    for i in range(4, 27):
-        y = i * hour_height
-        for x in range(0, width, 7):
-            draw.line((x, y, x, y), fill=1)
-    draw.line((0, 1 * hour_height, width, 1 * hour_height), fill=1)
-    draw.line((0, 3 * hour_height, width, 3 * hour_height), fill=1)
-    draw.line((column_width, 0, column_width, height), fill=1)
-    draw.text((column_width // 2, 10), today.strftime("%A"), fill=1, font=font, anchor='mm')
-    draw.text((column_width + column_width // 2, 10), tomorrow.strftime("%A"), fill=1, font=font, anchor='mm')
-
-    # Allday events
-    todayindex = 0
-    tomorrowindex = 0
-    for index, event in enumerate(processed_dateonly_events):
-        # print(f"dateonly: summary: {event[0].vobject_instance.vevent.summary.value}, start:{event[0].vobject_instance.vevent.dtstart.value}, end:{event[0].vobject_instance.vevent.dtend.value}")
-        event_start = event[0].vobject_instance.vevent.dtstart.value
-        event_end = event[0].vobject_instance.vevent.dtend.value
-        event_name = event[0].vobject_instance.vevent.summary.value
-        event_color = event[1]
-
-        if event_start == today and todayindex <= 2:
-            x = 0
-            y_start = (todayindex + 1) * hour_height + 1
-            y_end = (todayindex + 2) * hour_height - 1
-            todayindex = todayindex + 1
-        elif event_start == tomorrow and tomorrowindex <= 2:
-            x = column_width
-            y_start = (tomorrowindex + 1) * hour_height + 1
-            y_end = (tomorrowindex + 2) * hour_height - 1
-            tomorrowindex = tomorrowindex + 1
-        else:
+    # Allday events, up to three per day
+    alldayindex = {day: 0 for day in days}
+    for event in events:
+        if not event.allday or alldayindex.get(event.start, 3) > 2:
             continue
-
-        dith_rounded_rectangle(draw, [(x + 2, y_start), (x + column_width - 2, y_end)], 6, fill=event_color, outline=1, width=1)
-        draw.text((x + 10, y_start), textShortener(draw, column_width - 20, event_name, font), fill=1, font=font)
-
-
-
-    # Timed/Normal events
-    overlapside = "L"
-    for index, event in enumerate(processed_datetime_events):
-        # print(f"normal: summary: {event[0].vobject_instance.vevent.summary.value}, start:{event[0].vobject_instance.vevent.dtstart.value}, end:{event[0].vobject_instance.vevent.dtend.value}")
-        event_start = tzConvert(event[0].vobject_instance.vevent.dtstart.value)
-        event_end = tzConvert(event[0].vobject_instance.vevent.dtend.value)
-        event_name = event[0].vobject_instance.vevent.summary.value
-        event_color = event[1]
-
-        if event_start.date() == today:
-            x = 0
-        elif event_start.date() == tomorrow:
-            x = column_width
-        else:
-            continue
-
-        y_start = (event_start.hour + event_start.minute / 60 + 3) * hour_height
-        y_end = (event_end.hour + event_end.minute / 60 + 3) * hour_height
-
-        # print(f"event: {event_name}, ystart: {y_start}, ystop: {y_end}")
-        # Check for overlaps with the previous event
-        previous_overlap = False
-        if index > 0:
-            previous_event_end = tzConvert(processed_datetime_events[index - 1][0].vobject_instance.vevent.dtend.value)
-            if event_start < previous_event_end:
-                previous_overlap = True
-
-        # Check for overlaps with the next event
-        next_overlap = False
-        if index < len(processed_datetime_events) - 1:
-            next_event_start = tzConvert(processed_datetime_events[index + 1][0].vobject_instance.vevent.dtstart.value)
-            if event_end > next_event_start:
-                next_overlap = True
-
-        if previous_overlap or next_overlap:
-            if overlapside == "L":
-                dith_rounded_rectangle(draw, [(x + 2, y_start), (x + column_width // 2 - 2, y_end)], 6, fill=event_color, outline=1, width=1)
-                draw.text((x + 10, y_start + 2), textShortener(draw, column_width // 2 - 20, event_name, font), fill=1, font=font)
-                overlapside = "R"
-            elif overlapside == "R":
-                dith_rounded_rectangle(draw, [(x + column_width // 2 + 2, y_start), (x + column_width - 2, y_end)], 6, fill=event_color, outline=1, width=1)
-                draw.text((x + column_width // 2 + 10, y_start + 2), textShortener(draw, column_width // 2 - 20, event_name, font), fill=1, font=font)
-                overlapside = "L"
-        else:
-            dith_rounded_rectangle(draw, [(x + 2, y_start), (x + column_width - 2, y_end)], 6, fill=event_color, outline=1, width=1)
-            draw.text((x + 10, y_start + 2), textShortener(draw, column_width - 20, event_name, font), fill=1, font=font)
+        x = days.index(event.start) * column_width
+        y_start = (alldayindex[event.start] + 1) * hour_height + 1
+        y_end = (alldayindex[event.start] + 2) * hour_height - 1
+        alldayindex[event.start] += 1
+
+        dith_rounded_rectangle(draw, [(x + 2, y_start), (x + column_width - 2, y_end)], radius, fill=event.color, outline=1, width=1)
+        draw.text((x + inset(column_width), y_start), textShortener(draw, column_width - 2 * inset(column_width), event.title, font), fill=1, font=font)
+
+    def drawTimed(left, right, start, end, title, color, shorten=True):
+        # never hand dith_rounded_rectangle an empty or inverted box, however narrow the column
+        right = max(right, left + 5)
+        y_start = (start.hour + start.minute / 60 + 3) * hour_height
+        y_end = max((end.hour + end.minute / 60 + 3) * hour_height, y_start + 1)
+
+        dith_rounded_rectangle(draw, [(left + 2, y_start), (right - 2, y_end)], radius, fill=color, outline=1, width=1)
+        if shorten:
+            title = textShortener(draw, right - left - 2 * inset(right - left), title, font)
+        draw.text((left + inset(right - left), y_start + 2), title, fill=1, font=font)
+
+    # Timed/Normal events, overlapping ones split their day's column into as many boxes as fit;
+    # the events that don't fit are collapsed into a "+N" box in the last one
+    fit = max(1, column_width // plan["min_box"])
+    for index, day in enumerate(days):
+        x = index * column_width
+        timed = [event for event in events if not event.allday and event.start.date() == day]
+        hidden = []
+        for event, column, columns in layoutColumns(timed):
+            if columns > fit and column >= fit - 1:
+                hidden.append(event)
+                continue
+            columns = min(columns, fit)
+            drawTimed(x + column * column_width // columns, x + (column + 1) * column_width // columns, event.start, event.end, event.title, event.color)
+
+        # one "+N" box per stretch of time the collapsed events cover
+        left, right = x + (fit - 1) * column_width // fit, x + column_width
+        stretches = []
+        for event in hidden:
+            if stretches and event.start < stretches[-1][1]:
+                stretches[-1] = [stretches[-1][0], max(stretches[-1][1], event.end), stretches[-1][2] + 1]
+            else:
+                stretches.append([event.start, event.end, 1])
+        for start, end, count in stretches:
+            drawTimed(left, right, start, end, "+" + str(count), 0, shorten=False)
 
     return image
 
 if __name__ == "__main__":
     tagaccent = {}
     tagaccent["yellow"] = [255,255,0]
-    drawCalendar(tagaccent).save("calendar-dashboard.png")
+    drawCalendar(tagaccent, getCalendarEvents()).save("calendar-dashboard.png")
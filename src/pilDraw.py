@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from functools import lru_cache
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+import metrics
+
+SPRITE_CACHE_BYTES = 4 * 1024 * 1024 # for the masks of the sprite cache, one byte per pixel
+
+glyph_advances = {} # (font path, size): {character: advance width}
+backgrounds = {} # (widget, width, height, ..., palette): image with the widget's static parts
+sprites = OrderedDict() # (text, font path, size, anchor): (bbox, mask offset, 1-bit mask), least recently used first
+sprite_bytes = 0
+
+@lru_cache(maxsize=None)
+def getFont(path, size):
+    """Load a truetype font once and reuse it for every later render"""
+    return ImageFont.truetype(path, size)
+
+def fromBackground(key, palette, drawBackground):
+    """Return a copy of the static background for key, (widget, width, height, ...), to draw a render on.
+    drawBackground(draw) draws the grid, separators and labels on a blank image of this palette
+    the first time; later renders only copy it and draw their dynamic content."""
+    key = key + (tuple(palette),)
+    if key not in backgrounds:
+        background = Image.new("P", key[1:3])
+        background.putpalette(palette)
+        drawBackground(ImageDraw.Draw(background))
+        backgrounds[key] = background
+    return backgrounds[key].copy()
+
+def getSprite(text, font, anchor=None):
+    """Return a label as (font.getbbox, offset of the mask from the text position, 1-bit mask), shaped and
+    rasterized on first use only. The least recently used labels go once they take SPRITE_CACHE_BYTES."""
+    global sprite_bytes
+    key = (text, font.path, font.size, anchor)
+    sprite = sprites.get(key)
+    if sprite is not None:
+        sprites.move_to_end(key)
+        metrics.count("sprite_hits")
+        return sprite
+    metrics.count("sprite_misses")
+    # draw.text on a palette image draws without antialiasing, like on this 1-bit mask
+    left, top, right, bottom = font.getbbox(text, mode="1", anchor=anchor)
+    mask = Image.new("1", (max(1, right - left), max(1, bottom - top)))
+    ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=1, anchor=anchor)
+    sprite = sprites[key] = (font.getbbox(text, anchor=anchor), (left, top), mask)
+    sprite_bytes += mask.width * mask.height
+    while sprite_bytes > SPRITE_CACHE_BYTES:
+        _, (_, _, evicted) = sprites.popitem(last=False)
+        sprite_bytes -= evicted.width * evicted.height
+    return sprite
+
+def drawSprite(draw, xy, sprite, fill):
+    _, (left, top), mask = sprite
+    draw.bitmap((xy[0] + left, xy[1] + top), mask, fill=fill)
+
+def drawText(draw, xy, text, font, fill, anchor=None):
+    """draw.text at an integer position for labels that come back on every render, pasted from the sprite cache"""
+    drawSprite(draw, xy, getSprite(text, font, anchor), fill)
+
+def glyphAdvance(font, character):
+    advances = glyph_advances.setdefault((font.path, font.size), {})
+    if character not in advances:
+        advances[character] = font.getlength(character)
+    return advances[character]
+
+def textShortener(draw, displaywidth, text, font):
+    """Cut text until it fits displaywidth and mark the cut with a trailing dot.
+    The summed glyph advances guess the cut and textbbox only confirms it,
+    so a long text costs a few layout calls instead of one per removed character."""
+    def fits(length):
+        return draw.textbbox((0, 0), text[:length], font=font)[2] < displaywidth
+    if fits(len(text)):
+        return text
+
+    guess = 0
+    width = 0
+    for character in text:
+        width += glyphAdvance(font, character)
+        if width >= displaywidth:
+            break
+        guess += 1
+
+    # gallop away from the guess until the cut is bracketed, then bisect
+    low, high = 0, len(text) # fits(low), not fits(high)
+    step = 1
+    if fits(guess):
+        low = guess
+        while low + step < high and fits(low + step):
+            low += step
+            step *= 2
+        high = min(high, low + step)
+    else:
+        high = guess
+        while high - step > low and not fits(high - step):
+            high -= step
+            step *= 2
+        low = max(low, high - step)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+    return text[:low] + "."
+
+def checkerboard(width, height):
+    """Return an 'L' mask with 255 on every pixel where (x + y) is even"""
+    even = (b"\xff\x00" * (width // 2 + 1))[:width]
+    odd = (b"\x00\xff" * (width // 2 + 1))[:width]
+    rows = (even + odd) * (height // 2 + 1)
+    return Image.frombytes('L', (width, height), rows[:width * height])
+
+def dith_rounded_rectangle(draw, xy, radius, fill=0, outline=None, width=1):
+    (x1, y1), (x2, y2) = xy
+    x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+    # Create a mask image with rounded corners
+    mask = Image.new('L', (x2 - x1, y2 - y1), 0)
+    mask_draw = ImageDraw.Draw(mask)
+    mask_draw.rounded_rectangle((0, 0, x2 - x1, y2 - y1), radius, fill=255)
+
+    # Determine the fill color and whether it should be dithered
+    if fill > 2:
+        base_fill = fill - 3
+        dither = True
+    else:
+        base_fill = fill
+        dither = False
+
+    # Fill the whole mask at once; when dithering, the odd cells of the
+    # checkerboard stay white and only the even cells get the base colour
+    if dither:
+        draw.bitmap((x1, y1), mask, fill=0)
+        mask = ImageChops.darker(mask, checkerboard(x2 - x1, y2 - y1))
+    draw.bitmap((x1, y1), mask, fill=base_fill)
+
+    # Draw the outline if specified
+    if outline is not None:
+        draw.rounded_rectangle((x1, y1, x2, y2), radius, outline=outline, width=width)
@@ -1,23 +1,21 @@
-import requests
-import os
-from datetime import datetime, timedelta
-from PIL import Image, ImageDraw, ImageFont
-import configparser
-
-config = configparser.ConfigParser()
-config.read("config.ini")
-
-def getConfig(key, section='DEFAULT'):
-    # Check if the environment variable is set
-    env_value = os.getenv(key)
-    if env_value is not None:
-        return env_value
-    # If not set, return the value from the config file
-    return config.get(section, key)
-
-def draw_text_centered(draw, position, text, font, fill=None):
-    # Get text bounding box
-    left, top, right, bottom = font.getbbox(text)
+import time
+import threading
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
+from PIL import ImageDraw, ImageFont
+import httpClient
+from settings import settings
+from pilDraw import drawSprite, drawText, fromBackground, getFont, getSprite
+from layout import MIN_FONT_SIZE, scaler
+import metrics
+
+weather_cache = {} # ((latitude, longitude), variables): (fetch time, weather data, next sunrise or sunset)
+weather_lock = threading.Lock()
+
+def draw_text_centered(draw, position, text, font, fill=1):
+    # Get text bounding box, measured once with the cached sprite
+    sprite = getSprite(text, font)
+    left, top, right, bottom = sprite[0]
     text_width = right - left
     text_height = bottom - top
 
@@ -26,24 +24,69 @@ def draw_text_centered(draw, position, text, font, fill=None):
     y = position[1] - text_height // 2
 
     # Draw the text
-    draw.text((x, y), text, font=font, fill=fill)
+    drawSprite(draw, (x, y), sprite, fill)
 
 def get_weather_data():
-    """Fetch weather data from OpenMeteo API"""
-    base_url = "https://api.open-meteo.com/v1/forecast"
-
+    """Fetch the weather at LATITUDE/LONGITUDE, see get_weather_batch"""
+    location = (settings.latitude, settings.longitude)
+    return get_weather_batch([location])[location]
+
+def get_weather_batch(locations):
+    """Fetch weather data for every (latitude, longitude) from OpenMeteo, returns {location: data}.
+    Each location is cached for WEATHER_TTL seconds and the expired ones are fetched in one request.
+    Errors are raised, fetchData falls back to the last good data."""
     params = {
-        "latitude": getConfig("LATITUDE"),  # Default to Berlin, you should change this
-        "longitude": getConfig("LONGITUDE"),
         "current": ["is_day", "temperature_2m", "weather_code", "wind_speed_10m", "wind_direction_10m", "precipitation_probability"],
         "hourly": ["temperature_2m", "weather_code", "wind_speed_10m", "precipitation_probability"],
         "daily": ["weather_code", "temperature_2m_max", "temperature_2m_min", "precipitation_probability_max", "sunrise", "sunset"],
         "timezone": "auto",
         "forecast_days": 5
     }
+    variables = tuple((name, tuple(value) if isinstance(value, list) else value) for name, value in params.items())
+
+    weather = {}
+    # the lock makes concurrent renders wait for one request instead of sending their own
+    with weather_lock:
+        expired = []
+        for location in dict.fromkeys(locations):
+            cached = weather_cache.get((location, variables))
+            # is_day of a response from before sunrise or sunset is wrong after it
+            if cached is not None and time.monotonic() - cached[0] < settings.weather_ttl and (cached[2] is None or datetime.now() < cached[2]):
+                metrics.count("weather_cache_hits")
+                weather[location] = cached[1]
+            else:
+                expired.append(location)
+        if not expired:
+            return weather
+        # Open-Meteo takes comma separated coordinates and answers with one result per location
+        params["latitude"] = ",".join(str(latitude) for latitude, longitude in expired)
+        params["longitude"] = ",".join(str(longitude) for latitude, longitude in expired)
+        # a hung request isn't retried; the last good data is drawn instead
+        response = httpClient.get(settings.weather_url, params=params, timeout=settings.weather_timeout, retry_reads=False)
+        response.raise_for_status()
+        results = response.json()
+        if isinstance(results, dict):
+            results = [results]
+        if len(results) != len(expired):
+            raise ValueError(str(len(results)) + " results for " + str(len(expired)) + " locations")
+        for location, weather_data in zip(expired, results):
+            turns = [turn for turn in sunTurns(weather_data) if turn > datetime.now()]
+            weather_cache[(location, variables)] = (time.monotonic(), weather_data, min(turns, default=None))
+            weather[location] = weather_data
+        return weather
+
+def sunTurns(weather_data):
+    """The sunrises and sunsets of the forecast as naive local datetimes, like datetime.now().
+    Open-Meteo gives them in the location's timezone, its UTC offset is in the response."""
+    offset = timedelta(seconds=weather_data.get("utc_offset_seconds", 0))
+    daily = weather_data["daily"]
+    return sorted((datetime.fromisoformat(turn) - offset).replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None) for turn in daily["sunrise"] + daily["sunset"])
 
-    response = requests.get(base_url, params=params)
-    return response.json()
+def weatherChange(weather_data, now):
+    """The next moment drawWeather's output changes without new data: the hourly forecast moves on
+    every full hour (the daily one with midnight), the current icon at sunrise and sunset"""
+    next_hour = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    return min([next_hour] + [turn for turn in sunTurns(weather_data) if turn > now])
 
 def getWeatherIcons(code, isDay=True):
     """Convert OpenMeteo weather code to weathericons.ttf character"""
@@ -97,25 +140,97 @@ def get_wind_direction_icon(degrees):
     index = round(degrees / 45) % 8
     return directions[index]
 
-def drawWeather(tagaccent, width=500, height=430):
-    """Create the weather widget with the three sections"""
-    # Create a new image with white background
-    image = Image.new('P', (width, height))
+def drawSeparators(draw, width, section_height, sections=3):
+    """The static part of the weather widget: section borders and the dotted lines between columns"""
+    if sections < 3:
+        return
+    draw.line([(0, section_height), (width, section_height)], fill=1, width=2)
+    draw.line([(0, section_height*2), (width, section_height*2)], fill=1, width=2)
+    hour_width = width // 7
+    day_width = width // 4
+    dots = [(i * hour_width, y) for i in range(1, 7) for y in range(section_height, section_height * 2, 7)]
+    dots += [(i * day_width, y) for i in range(1, 5) for y in range(section_height * 2, section_height * 3, 7)]
+    draw.point(dots, fill=1)
+
+def drawFitting(draw, xy, texts, font, width):
+    """drawText the first of texts that ends within width, none if even the last one doesn't"""
+    for text in texts:
+        sprite = getSprite(text, font)
+        if xy[0] + sprite[0][2] <= width:
+            drawSprite(draw, xy, sprite, fill=1)
+            return
+
+@lru_cache(maxsize=None)
+def weatherPlan(width, height):
+    """Font sizes and offsets of the weather widget at this size, scaled from its 500x430 design.
+    The hourly and daily forecasts only fit while their 18px labels scale to MIN_FONT_SIZE or more;
+    smaller widgets only show the current weather, scaled from the design's top third."""
+    sections = 3 if 18 * min(width / 500, height / 430) >= MIN_FONT_SIZE else 1
+    if sections == 1 and height > width:
+        # tall and narrow: the current weather stacked, scaled from a 150x270 design
+        x, y, size, font = scaler(width, height, 150, 270)
+        return {
+            "fonts": {"bigweather": font(60), "weather": font(45), "large": font(30), "medium": font(16), "small": font(18)},
+            "sections": sections,
+            "section_height": height,
+            "icon": (x(5), y(0)),
+            "wind_icon": (x(85), y(0)),
+            "temperature": (x(10), y(100)),
+            "wind": (x(10), y(155)),
+            "precipitation": (x(10), y(190)),
+            "sun": (x(10), y(225)),
+        }
+    design_height = 430
+    if sections == 1:
+        # rows spaced for their 24px text at its scaled or minimum size, rather than stretched over the widget
+        design_height = height / min(height / 143, max(width / 500, MIN_FONT_SIZE / 24))
+    x, y, size, font = scaler(width, height, 500, design_height)
+    return {
+        "fonts": {"bigweather": font(100), "weather": font(45), "large": font(26), "medium": font(24), "small": font(18)},
+        "sections": sections,
+        "section_height": height // sections,
+        # current weather, top left positions
+        "icon": (x(10), y(0)),
+        "temperature": (x(150), y(15)),
+        "wind": (x(150), y(50)),
+        "wind_icon": (x(410), y(-20)),
+        "precipitation": (x(150), y(75)),
+        "sun": (x(150), y(100)),
+        # hourly and daily forecast, offsets from each column's center and its section's top
+        "hourly_top": -y(2),
+        "hourly_icon": (-x(24), y(23)),
+        "hourly_rows": (y(10), y(90), y(110), y(130)),
+        "daily_top": y(5),
+        "daily_icon": (-x(25), y(30)),
+        "daily_rows": (y(10), y(95), y(120)),
+    }
+
+def weatherInputs(tagaccent, weather_data, width=500, height=430):
+    """Everything drawWeather's output depends on, for the tile cache"""
+    now = datetime.now()
+    return (now.date(), now.hour, tagaccent, weather_data, width, height, settings.weather_font)
+
+def drawWeather(tagaccent, weather_data, width=500, height=430):
+    """Create the weather widget with the three sections from the data of get_weather_data"""
+    plan = weatherPlan(width, height)
     palette = [
         255, 255, 255,
         0, 0, 0,
         next(iter(tagaccent.values()))[0], next(iter(tagaccent.values()))[1], next(iter(tagaccent.values()))[2]
     ]
-    image.putpalette(palette)
+    # Start from the section borders and dotted column separators, drawn once per size
+    image = fromBackground(("weather", width, height), palette, lambda draw: drawSeparators(draw, width, plan["section_height"], plan["sections"]))
     draw = ImageDraw.Draw(image)
 
+    sizes = plan["fonts"]
+
     # Load fonts
     try:
-        bigweather_font = ImageFont.truetype("./fonts/weathericons.ttf", 100)
-        weather_font = ImageFont.truetype("./fonts/weathericons.ttf", 45)
-        large_font = ImageFont.truetype(getConfig("WEATHER_FONT"), 26)
-        medium_font = ImageFont.truetype(getConfig("WEATHER_FONT"), 24)
-        small_font = ImageFont.truetype(getConfig("WEATHER_FONT"), 18)
+        bigweather_font = getFont("./fonts/weathericons.ttf", sizes["bigweather"])
+        weather_font = getFont("./fonts/weathericons.ttf", sizes["weather"])
+        large_font = getFont(settings.weather_font, sizes["large"])
+        medium_font = getFont(settings.weather_font, sizes["medium"])
+        small_font = getFont(settings.weather_font, sizes["small"])
     except IOError:
         # Fallback to default fonts if custom fonts are not available
         bigweather_font = ImageFont.load_default()
@@ -124,15 +239,8 @@ def drawWeather(tagaccent, width=500, height=430):
         medium_font = ImageFont.load_default()
         small_font = ImageFont.load_default()
 
-    # Get weather data
-    weather_data = get_weather_data()
-
     # Section heights
-    section_height = height // 3
-
-    # Draw section borders for visual clarity
-    draw.line([(0, section_height), (width, section_height)], fill=1, width=2)
-    draw.line([(0, section_height*2), (width, section_height*2)], fill=1, width=2)
+    section_height = plan["section_height"]
 
     # Top Section - Current Weather
     current = weather_data["current"]
@@ -140,26 +248,29 @@ def drawWeather(tagaccent, width=500, height=430):
 
     # Weather icon
     icon = getWeatherIcons(current["weather_code"], current["is_day"])
-    draw.text((10, 0), icon, fill=1, font=bigweather_font)
+    drawText(draw, plan["icon"], icon, bigweather_font, fill=1)
 
     # Current temperature
     temp_text = f"{current['temperature_2m']:.1f}°C"
-    draw.text((150, 15), temp_text, fill=1, font=large_font)
+    drawText(draw, plan["temperature"], temp_text, large_font, fill=1)
 
     # Wind info
     wind_speed = f"{current['wind_speed_10m']:.1f} km/h"
     wind_icon = get_wind_direction_icon(current["wind_direction_10m"])
-    draw.text((150, 50), f"Wind: {wind_speed}", fill=1, font=medium_font)
-    draw.text((410, -20), wind_icon, fill=1, font=bigweather_font)
+    drawFitting(draw, plan["wind"], [f"Wind: {wind_speed}", wind_speed], medium_font, width)
+    drawText(draw, plan["wind_icon"], wind_icon, bigweather_font, fill=1)
 
     # Precipitation chance
-    precip_text = f"Precipitation: {current['precipitation_probability']}%"
-    draw.text((150, 75), precip_text, fill=1, font=medium_font)
+    precipitation = current['precipitation_probability']
+    drawFitting(draw, plan["precipitation"], [f"Precipitation: {precipitation}%", f"Precip: {precipitation}%"], medium_font, width)
 
     # Sunrise/Sunset
     sunrise = format_time(daily["sunrise"][0])
     sunset = format_time(daily["sunset"][0])
-    draw.text((150, 100), f"Sunrise: {sunrise} | Sunset: {sunset}", fill=1, font=medium_font)
+    drawFitting(draw, plan["sun"], [f"Sunrise: {sunrise} | Sunset: {sunset}", f"Sun: {sunrise}-{sunset}"], medium_font, width)
+
+    if plan["sections"] < 3:
+        return image
 
     # Middle Section - 7-hour Forecast
     hourly = weather_data["hourly"]
@@ -167,76 +278,67 @@ def drawWeather(tagaccent, width=500, height=430):
     hour_width = width // 7
 
     for i in range(7):
-        # decorative dotted lines
-        xdot = (i + 1) * hour_width
-        if not i == 6:
-            for y in range(section_height, section_height * 2, 7):
-                draw.line((xdot, y, xdot, y), fill=1)
-
         hour_index = current_hour + i + 1
         if hour_index >= 24:
             hour_index = hour_index - 24
 
         x_pos = i * hour_width + hour_width // 2
-        y_pos = section_height - 2
+        y_pos = section_height + plan["hourly_top"]
+        time_row, temperature_row, wind_row, precipitation_row = plan["hourly_rows"]
 
         # Time
         time_text = f"{hour_index:02d}:00"
-        draw_text_centered(draw, (x_pos, y_pos + 10), time_text, fill=1, font=small_font)
+        draw_text_centered(draw, (x_pos, y_pos + time_row), time_text, fill=1, font=small_font)
 
         # Weather icon
         icon = getWeatherIcons(hourly["weather_code"][hour_index])
-        draw.text((x_pos - 24, y_pos + 23), icon, fill=1, font=weather_font)
+        drawText(draw, (x_pos + plan["hourly_icon"][0], y_pos + plan["hourly_icon"][1]), icon, weather_font, fill=1)
 
         # Temperature
         temp_text = f"{hourly['temperature_2m'][hour_index]:.1f}°C"
-        draw_text_centered(draw, (x_pos, y_pos + 90), temp_text, fill=1, font=small_font)
+        draw_text_centered(draw, (x_pos, y_pos + temperature_row), temp_text, fill=1, font=small_font)
 
         # Wind speed
         wind_text = f"{hourly['wind_speed_10m'][hour_index]:.0f} km/h"
-        draw_text_centered(draw, (x_pos, y_pos + 110), wind_text, fill=1, font=small_font)
+        draw_text_centered(draw, (x_pos, y_pos + wind_row), wind_text, fill=1, font=small_font)
 
         # Precipitation
         precip_text = f"{hourly['precipitation_probability'][hour_index]}%"
-        draw_text_centered(draw, (x_pos, y_pos + 130), precip_text, fill=1, font=small_font)
+        draw_text_centered(draw, (x_pos, y_pos + precipitation_row), precip_text, fill=1, font=small_font)
 
     # Bottom Section - 4-day Forecast
     day_width = width // 4
 
     for i in range(4):
-        # decorative dotted lines
-        xdot = (i + 1) * day_width
-        for y in range(section_height * 2, section_height * 3, 7):
-            draw.line((xdot, y, xdot, y), fill=1)
-
         day_index = i  # Start today
         x_pos = i * day_width + day_width // 2
-        y_pos = section_height * 2 + 5
+        y_pos = section_height * 2 + plan["daily_top"]
+        date_row, temperature_row, precipitation_row = plan["daily_rows"]
 
         # Date
         today = datetime.now()
         forecast_date = today + timedelta(days=day_index)
         date_text = forecast_date.strftime("%a %d.%m")
-        draw_text_centered(draw, (x_pos, y_pos + 10), date_text, fill=1, font=medium_font)
+        draw_text_centered(draw, (x_pos, y_pos + date_row), date_text, fill=1, font=medium_font)
 
         # Weather icon
         icon = getWeatherIcons(daily["weather_code"][day_index])
-        draw.text((x_pos - 25, y_pos + 30), icon, fill=1, font=weather_font)
+        drawText(draw, (x_pos + plan["daily_icon"][0], y_pos + plan["daily_icon"][1]), icon, weather_font, fill=1)
 
         # Temperature range
         temp_min = daily["temperature_2m_min"][day_index]
         temp_max = daily["temperature_2m_max"][day_index]
         temp_text = f"{temp_min:.1f}°C-{temp_max:.1f}°C"
-        draw_text_centered(draw, (x_pos, y_pos + 95), temp_text, fill=1, font=small_font)
+        draw_text_centered(draw, (x_pos, y_pos + temperature_row), temp_text, fill=1, font=small_font)
 
         # Precipitation
         precip_text = f"Precip: {daily['precipitation_probability_max'][day_index]}%"
-        draw_text_centered(draw, (x_pos, y_pos + 120), precip_text, fill=1, font=small_font)
+        draw_text_centered(draw, (x_pos, y_pos + precipitation_row), precip_text, fill=1, font=small_font)
 
     return image
 
 if __name__ == "__main__":
     tagaccent = {}
     tagaccent["yellow"] = [255,255,0]
-    drawWeather(tagaccent).save("weather_dashboard.png")
+    drawWeather(tagaccent, get_weather_data()).save("weather_dashboard.png")
     # weather_widget.show()  # Display the image
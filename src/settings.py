@@ -0,0 +1,132 @@
+import os
+import configparser
+from dataclasses import MISSING, dataclass, field, fields
+
+WIDGETS = ("header", "calendar", "weather")
+
+@dataclass(frozen=True)
+class Settings:
+    """Every config key, read once from config.ini with environment variables taking precedence.
+    A field is named after its key in lowercase; fields without a default are required."""
+    accesspointip: list
+    mac: str
+    widgets: list = field(default_factory=lambda: list(WIDGETS))
+    fleet_workers: int = 0
+    cache_dir: str = "./cache"
+    tagdb_ttl: int = 21600
+    http_connect_timeout: float = 5
+    http_read_timeout: float = 30
+    http_retries: int = 3
+    http_backoff: float = 0.5
+    http_host_concurrency: int = 2
+    caldav_url: str = ""
+    cal_username: str = ""
+    cal_password: str = ""
+    calendar_name: list = field(default_factory=list)
+    calendar_color: list = field(default_factory=list)
+    timezone: str = "UTC"
+    calendar_font: str = "fonts/Roboto-SemiBold.ttf"
+    calendar_days: int = 2
+    latitude: float = 0
+    longitude: float = 0
+    weather_locations: dict = field(default_factory=dict)
+    weather_url: str = "https://api.open-meteo.com/v1/forecast"
+    weather_ttl: int = 900
+    weather_timeout: float = 10
+    weather_font: str = "fonts/Roboto-SemiBold.ttf"
+    header_font: str = "fonts/Roboto-SemiBold.ttf"
+    calendar_deadline: float = 30
+    weather_deadline: float = 30
+    refresh_budget: float = 90
+    breaker_failures: int = 3
+    breaker_cooldown: int = 300
+    refresh_interval: int = 3600
+    refresh_jitter: int = 60
+    refresh_min_interval: int = 60
+    force_refresh: bool = False
+    upload_format: str = "JPEG"
+    raw_upload_path: str = ""
+    save_image: bool = False
+    skipupload: bool = False
+    metrics_log: str = ""
+    metrics_prom: str = ""
+
+    def __post_init__(self):
+        problems = []
+        if not self.accesspointip:
+            problems.append("ACCESSPOINTIP is empty, set it to the IP of the AP or a comma separated list of APs")
+        if not self.mac.strip():
+            problems.append("MAC is empty, set it to the tags to render or \"all\"")
+        problems += ["unknown widget " + widget for widget in self.widgets if widget not in WIDGETS]
+        if "calendar" in self.widgets:
+            if not self.caldav_url:
+                problems.append("CALDAV_URL is required for the calendar widget")
+            if len(self.calendar_color) < len(self.calendar_name):
+                problems.append("CALENDAR_COLOR needs one color per CALENDAR_NAME")
+            if not 1 <= self.calendar_days <= 7:
+                problems.append("CALENDAR_DAYS must be between 1 and 7")
+        if not (-90 <= self.latitude <= 90 and -180 <= self.longitude <= 180):
+            problems.append("LATITUDE/LONGITUDE are out of range")
+        for mac, location in self.weather_locations.items():
+            if len(location) != 2 or not (-90 <= location[0] <= 90 and -180 <= location[1] <= 180):
+                problems.append("WEATHER_LOCATIONS of " + mac + " must be LATITUDE/LONGITUDE in range")
+        if self.refresh_budget <= 0:
+            problems.append("REFRESH_BUDGET must be positive")
+        if self.breaker_failures < 1:
+            problems.append("BREAKER_FAILURES must be at least 1")
+        if not 0 <= self.refresh_min_interval <= self.refresh_interval:
+            problems.append("REFRESH_MIN_INTERVAL must be between 0 and REFRESH_INTERVAL")
+        if self.upload_format not in ("JPEG", "PNG", "RAW"):
+            problems.append("UPLOAD_FORMAT must be JPEG, PNG or RAW")
+        if self.upload_format == "RAW" and not self.raw_upload_path:
+            problems.append("UPLOAD_FORMAT = RAW needs the AP's raw upload endpoint in RAW_UPLOAD_PATH")
+        if problems:
+            raise ValueError("Invalid configuration: " + "; ".join(problems))
+
+def convert(key, kind, value):
+    value = value.strip()
+    if kind is bool:
+        if value.lower() in ("true", "yes", "on", "1"):
+            return True
+        if value.lower() in ("false", "no", "off", "0"):
+            return False
+        raise ValueError("Invalid configuration: " + key + " must be True or False, not " + repr(value))
+    if kind is list:
+        return [item.strip() for item in value.split(",") if item.strip()]
+    if kind is dict:
+        # "KEY=VALUE, OTHER KEYS=VALUE", every whitespace separated key gets the value
+        items = {}
+        for item in convert(key, list, value):
+            keys, separator, itemvalue = item.partition("=")
+            if not separator:
+                raise ValueError("Invalid configuration: " + key + " items must look like KEY=VALUE, not " + repr(item))
+            items.update(dict.fromkeys(keys.split(), itemvalue.strip()))
+        return items
+    try:
+        return kind(value)
+    except ValueError:
+        raise ValueError("Invalid configuration: " + key + " must be a" + ("n integer" if kind is int else " number") + ", not " + repr(value)) from None
+
+def load(path="config.ini"):
+    """Read and validate the settings, raises ValueError naming every bad key"""
+    config = configparser.ConfigParser()
+    config.read(path)
+    values = {}
+    for setting in fields(Settings):
+        key = setting.name.upper()
+        value = os.getenv(key)
+        if value is None:
+            value = config.get("DEFAULT", key, fallback=None)
+        # empty keys in config.ini mean "use the default"
+        if value is None or (value.strip() == "" and setting.type is not str):
+            continue
+        values[setting.name] = convert(key, setting.type, value)
+    missing = [setting.name.upper() for setting in fields(Settings) if setting.name not in values and setting.default is MISSING and setting.default_factory is MISSING]
+    if missing:
+        raise ValueError("Invalid configuration: " + ", ".join(missing) + " not set")
+    values["calendar_color"] = [convert("CALENDAR_COLOR", int, color) for color in values.get("calendar_color", [])]
+    values["weather_locations"] = {mac: tuple(convert("WEATHER_LOCATIONS", float, coordinate) for coordinate in location.split("/", 1)) for mac, location in values.get("weather_locations", {}).items()}
+    values["upload_format"] = values.get("upload_format", "JPEG").upper()
+    return Settings(**values)
+
+settings = load()